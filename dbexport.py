@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+# SmartValidator - simulator component
+# by Tomas Hlavacek (tmshlvck@gmail.com)
+
+"""
+Database access and prefix list writing shared by the filter exporters
+retreivefilter.py and retreivedbfilter.py.
+"""
+
+# rows fetched from the server-side cursor at once
+fetch_size=10000
+
+import os
+import ipaddress
+
+try:
+    import password
+    import psycopg2
+    db_host=password.db_host
+    db_name=password.db_name
+    db_user=password.db_user
+    db_passwd=password.db_passwd
+except ImportError:
+    # no database access configured, the connection has to be passed
+    # to dbselect (e.g. sqlite3 stand-in)
+    psycopg2 = None
+
+
+def dbconn():
+    return 'host=%s dbname=%s user=%s password=%s' % (db_host, db_name, db_user, db_passwd)
+
+
+def dbconnect():
+    return psycopg2.connect(dbconn())
+
+
+def dbselect(select, conn=None):
+    """
+        Stream rows of the select in batches of fetch_size. PostgreSQL
+        gets a named (server-side) cursor, so the result is not loaded into
+        memory at once. conn is an open DB-API connection, new connection
+        by dbconnect() is used when it is None.
+    """
+    own = conn is None
+    if own:
+        conn = dbconnect()
+    try:
+        cur = conn.cursor(name='svexport')
+    except TypeError:
+        # no server-side cursors, e.g. sqlite3
+        cur = conn.cursor()
+    try:
+        cur.execute(select)
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            for r in rows:
+                yield r
+    finally:
+        cur.close()
+        if own:
+            conn.close()
+
+
+def dbcopy(select, outfh, conn=None):
+    """
+        Write result of the select to outfh by COPY ... TO STDOUT (text
+        format, one column per line for select of prefixes).
+    """
+    own = conn is None
+    if own:
+        conn = dbconnect()
+    try:
+        cur = conn.cursor()
+        cur.copy_expert("COPY (%s) TO STDOUT" % select.strip().rstrip(';'), outfh)
+        cur.close()
+    finally:
+        if own:
+            conn.close()
+
+
+def copy_prefixes(select, outfn, conn=None):
+    """
+        Write prefix list selected by select to outfn by dbcopy, the file
+        is replaced at once when it is complete.
+    """
+    tmpfn = '%s.tmp%d' % (outfn, os.getpid())
+    with open(tmpfn, "w") as outfh:
+        dbcopy(select, outfh, conn)
+    os.replace(tmpfn, outfn)
+
+
+def format_prefix(r):
+    """
+        Convert row with prefix in the first column to the line of prefix
+        list read by nfsim.
+    """
+    return "%s\n" % ipaddress.ip_network(str(r[0]), strict=False)
+
+
+def write_prefixes(rows, outfn):
+    """
+        Write prefix list from rows to outfn, the file is replaced at once
+        when it is complete. Returns number of prefixes.
+    """
+    count = 0
+    tmpfn = '%s.tmp%d' % (outfn, os.getpid())
+    with open(tmpfn, "w") as outfh:
+        for r in rows:
+            outfh.write(format_prefix(r))
+            count += 1
+    os.replace(tmpfn, outfn)
+    return count
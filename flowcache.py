@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# SmartValidator - simulator component
+# by Tomas Hlavacek (tmshlvck@gmail.com)
+
+import os
+import json
+import shutil
+import numpy
+
+# columns of the cached flows and their on-disk types (little endian)
+columns = ['date', 'duration', 'protocol', 'src', 'srcport', 'dst', 'dstport', 'packets', 'bytes', 'flows']
+column_types = {
+    'date': '<f8', # UNIX timestamp of the flow start
+    'duration': '<f8',
+    'protocol': '<u1',
+    'src': '<u4',
+    'srcport': '<u2',
+    'dst': '<u4',
+    'dstport': '<u2',
+    'packets': '<u8',
+    'bytes': '<u8',
+    'flows': '<u4',
+}
+
+cache_version = 1
+
+
+def _source_meta(srcfn):
+    st = os.stat(srcfn)
+    return {'version': cache_version, 'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+
+def load(path, srcfn, size=65536):
+    """ Replay flows from the cache.
+
+    :param str path: Cache directory of the nfcapd file
+    :param str srcfn: The nfcapd file, the cache is valid only when it did \
+    not change since the cache was written
+    :param int size: Flows per yielded chunk
+    :returns: Iterator of chunks (dict column name -> numpy array) or None \
+    when there is no valid cache
+    """
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r') as fh:
+            meta = json.load(fh)
+        count = meta.pop('count')
+        if meta != _source_meta(srcfn):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+
+    def replay():
+        if not count:
+            return
+        cols = {c: numpy.memmap(os.path.join(path, '%s.bin' % c), dtype=column_types[c], mode='r', shape=(count,)) for c in columns}
+        for i in range(0, count, size):
+            yield {c: cols[c][i:i+size] for c in columns}
+
+    return replay()
+
+
+def store(path, srcfn, chunks, datefn=float):
+    """ Pass chunks through and write them to the cache on the way.
+    The cache becomes valid only after all chunks were consumed.
+
+    :param str path: Cache directory of the nfcapd file
+    :param str srcfn: The nfcapd file the flows were read from
+    :param chunks: Iterable of chunks (dict column name -> sequence)
+    :param datefn: Conversion of values in the date column to UNIX timestamp
+    :returns: Iterator that yields the chunks
+    """
+    meta = _source_meta(srcfn)
+    tmppath = '%s.tmp%d' % (path, os.getpid())
+    shutil.rmtree(tmppath, ignore_errors=True)
+    os.makedirs(tmppath)
+
+    count = 0
+    fhs = {c: open(os.path.join(tmppath, '%s.bin' % c), 'wb') for c in columns}
+    try:
+        for chunk in chunks:
+            for c in columns:
+                try:
+                    col = numpy.asarray(chunk[c], dtype=column_types[c])
+                except (TypeError, ValueError):
+                    # dates as datetime or nfdump strings
+                    col = numpy.array([datefn(d) for d in chunk[c]], dtype=column_types[c])
+                col.tofile(fhs[c])
+            count += len(chunk['src'])
+            yield chunk
+    except BaseException:
+        for fh in fhs.values():
+            fh.close()
+        shutil.rmtree(tmppath, ignore_errors=True)
+        raise
+
+    for fh in fhs.values():
+        fh.close()
+    meta['count'] = count
+    with open(os.path.join(tmppath, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmppath, path)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# SmartValidator - simulator component
+# by Tomas Hlavacek (tmshlvck@gmail.com)
+
+"""
+HyperLogLog (Flajolet et al.) sketches for counting distinct addresses and
+prefixes of the dropped traffic. Sketches of the same precision are merged
+by taking the register maximum, so per-file sketches can be rolled up to
+hours and days without reprocessing the flows:
+
+    hll.py -o <out.json> <sidecar.json> ...
+"""
+
+import sys
+import math
+import json
+import getopt
+import base64
+import hashlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MASK64 = (1 << 64) - 1
+
+
+def hash_int(x):
+    """ 64-bit mix (splitmix64 finalizer) of non-negative int x.
+
+    :param int x: Value (e.g. IPv4 address)
+    :returns: int
+    """
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def hash_array(a):
+    """ hash_int of every value of numpy array a.
+
+    :param a: numpy array of non-negative ints
+    :returns: numpy uint64 array
+    """
+    x = a.astype(numpy.uint64) + numpy.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return x ^ (x >> numpy.uint64(31))
+
+
+def hash_str(s):
+    """ 64-bit hash of string s, stable across processes.
+
+    :param str s: Value (e.g. prefix)
+    :returns: int
+    """
+    return int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), 'little')
+
+
+class HyperLogLog(object):
+    """ HyperLogLog sketch with 2^p one byte registers. """
+
+    def __init__(self, p=12):
+        """
+        :param int p: Precision, standard error is about 1.04/sqrt(2^p)
+        """
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add_hash(self, h):
+        """ Add item given by its 64-bit hash.
+
+        :param int h: Hash
+        """
+        idx = h >> (64 - self.p)
+        # position of the first one bit in the rest (at most 64-p bits long)
+        w = ((h << self.p) & MASK64) | (1 << (self.p - 1))
+        rank = 64 - w.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def add_int(self, x):
+        self.add_hash(hash_int(x))
+
+    def add_str(self, s):
+        self.add_hash(hash_str(s))
+
+    def add_array(self, a):
+        """ Add all values of numpy array a of non-negative ints.
+
+        :param a: numpy array
+        """
+        if not len(a):
+            return
+        h = hash_array(numpy.unique(a))
+        idx = (h >> numpy.uint64(64 - self.p)).astype(numpy.intp)
+        w = (h << numpy.uint64(self.p)) | numpy.uint64(1 << (self.p - 1))
+        # count leading zeros of w
+        lz = numpy.zeros(len(w), dtype=numpy.uint8)
+        for s in (32, 16, 8, 4, 2, 1):
+            z = (w >> numpy.uint64(64 - s)) == 0
+            lz[z] += s
+            w[z] <<= numpy.uint64(s)
+        regs = numpy.frombuffer(self.registers, dtype=numpy.uint8)
+        numpy.maximum.at(regs, idx, lz + 1)
+
+    def merge(self, other):
+        """ Add items of other sketch to this one.
+
+        :param HyperLogLog other: Sketch of the same precision
+        :returns: self
+        """
+        if other.p != self.p:
+            raise ValueError("Can not merge HyperLogLog of precision %d and %d" % (self.p, other.p))
+        self.registers = bytearray(max(a, b) for (a, b) in zip(self.registers, other.registers))
+        return self
+
+    def estimate(self):
+        """ Estimated number of distinct items.
+
+        :returns: int
+        """
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        e = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if e <= 2.5 * m and zeros:
+            # small range correction (linear counting)
+            e = m * math.log(m / zeros)
+        return int(round(e))
+
+    def to_dict(self):
+        return {'p': self.p, 'registers': base64.b64encode(bytes(self.registers)).decode('ascii')}
+
+    @staticmethod
+    def from_dict(d):
+        h = HyperLogLog(d['p'])
+        h.registers = bytearray(base64.b64decode(d['registers']))
+        return h
+
+
+# sketches of the dropped traffic kept in the sidecars
+sidecar_keys = ('src', 'dst', 'prefix')
+
+
+def write_sidecar(filename, sketches, meta=None):
+    """ Write sketches to JSON sidecar file.
+
+    :param str filename: Output file name
+    :param dict sketches: Sketches (HyperLogLog) by sidecar_keys
+    :param dict meta: Optional description (file, router, time, filter)
+    """
+    d = dict(meta or {})
+    for (k, h) in sketches.items():
+        d[k] = h.to_dict()
+    with open(filename, 'w') as fh:
+        json.dump(d, fh)
+
+
+def read_sidecar(filename):
+    """ Read sketches from JSON sidecar file.
+
+    :param str filename: Sidecar file name
+    :returns: dict of HyperLogLog by sidecar_keys
+    """
+    with open(filename, 'r') as fh:
+        d = json.load(fh)
+    return dict((k, HyperLogLog.from_dict(d[k])) for k in sidecar_keys if k in d)
+
+
+def main():
+    def usage():
+        print("""Merge distinct count sidecars
+    %s -o <out.json> <sidecar.json> ...
+        -h | --help
+        -o | --outfile <merged sidecar>
+""" % sys.argv[0])
+
+    outfn = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:", ["help", "outfile="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-o", "--outfile"):
+            outfn = a
+        else:
+            assert False, "unhandled option"
+
+    assert args, "missing sidecar files"
+    assert outfn, "missing out file"
+
+    merged = {}
+    for fn in args:
+        for (k, h) in read_sidecar(fn).items():
+            if k in merged:
+                merged[k].merge(h)
+            else:
+                merged[k] = h
+    meta = {'files': len(args)}
+    meta.update(('%s_estimate' % k, h.estimate()) for (k, h) in merged.items())
+    write_sidecar(outfn, merged, meta)
+
+
+if __name__ == '__main__':
+    main()
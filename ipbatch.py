@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# SmartValidator - simulator component
+# by Tomas Hlavacek (tmshlvck@gmail.com)
+
+import numpy
+
+
+class IPIntervalSet(object):
+    """ Flat IPv4 prefix set for matching whole arrays of addresses at once.
+    Prefixes are merged into sorted non-overlapping intervals of uint32 so
+    that a single numpy.searchsorted call answers containment for every
+    address in a batch. Only membership is kept, the data bound to
+    prefixes in IPLookupTree is not available here. """
+    def __init__(self, prefixes=()):
+        """
+        :param prefixes: Iterable of (value, length) pairs, value is \\
+        the integer IPv4 network address
+        """
+        intervals = sorted((v, v | ((1 << (32 - l)) - 1)) for (v, l) in prefixes)
+
+        starts = []
+        lasts = []
+        for (first, last) in intervals:
+            if lasts and first <= lasts[-1] + 1:
+                # overlapping or adjacent, extend the previous interval
+                if last > lasts[-1]:
+                    lasts[-1] = last
+            else:
+                starts.append(first)
+                lasts.append(last)
+
+        self.starts = numpy.array(starts, dtype=numpy.uint32)
+        self.lasts = numpy.array(lasts, dtype=numpy.uint32)
+
+    @staticmethod
+    def fromTree(tree):
+        """ Build the set from prefixes stored in IPLookupTree.
+
+        :param tree: iptree.IPLookupTree (IPv4)
+        :returns: IPIntervalSet
+        """
+        if tree.ipv6:
+            raise ValueError("IPIntervalSet supports IPv4 only")
+        return IPIntervalSet((v, l) for (v, l, d) in tree.iterPrefixes())
+
+    def __len__(self):
+        return len(self.starts)
+
+    def contains(self, addrs):
+        """ Match array of addresses.
+
+        :param addrs: Array-like of integer IPv4 addresses
+        :returns: numpy array of bools, True where the address falls \\
+        into some prefix of the set
+        """
+        addrs = numpy.asarray(addrs, dtype=numpy.uint32)
+        if not len(self.starts):
+            return numpy.zeros(addrs.shape, dtype=bool)
+
+        idx = numpy.searchsorted(self.starts, addrs, side='right') - 1
+        hit = idx >= 0
+        return hit & (addrs <= self.lasts[numpy.maximum(idx, 0)])
@@ -26,18 +26,30 @@
 # SUCH DAMAGE.
 #
 
+import sys
+import getopt
+import random
 import ipaddress
 
 
 class _IPLookupTreeNode(object):
     """ Internal Node for the IPLookupTree. Should not be
-    even public unless cPickle needs it. How unfortunate... """
-    def __init__(self):
+    even public unless cPickle needs it. How unfortunate...
+
+    The tree is path-compressed, so a node stands for a prefix given
+    by an integer value (left-aligned to the tree width) and a length.
+    Children hang on the first bit that follows the node prefix. """
+    __slots__ = ('value', 'length', 'one', 'zero', 'end', 'data')
+
+    def __init__(self, value=0, length=0):
+        self.value=value # int, prefix bits left-aligned to the tree width
+        self.length=length # int, prefix length
         self.one=None # _IPLookupTreeNode or None
         self.zero=None # _IPLookupTreeNode or None
-        self.end=None # ipaddress.IP46Network
+        self.end=False # True when the prefix has been added to the tree
         self.data=None # cave pickle
-    
+
+
 class IPLookupTree(object):
     """ Lookup tree for holding list of IP (IPv4/IPv6) prefixes. """
     def __init__(self,ipv6=False):
@@ -45,20 +57,33 @@ class IPLookupTree(object):
         :param bool ipv6: IPv6 flag
         """
         self.ipv6=ipv6
+        self.width=128 if ipv6 else 32
         self.root=_IPLookupTreeNode()
 
-    @staticmethod
-    def _bits(chararray):
-        """ Convert 8-bit chars to list of bools (bits)
-        :param chararray: 8-bit chars
-        :returns: Iterator that yields bits
-        """
-        for c in chararray:
-            for i in range(7,-1,-1):
-                if c & (1 << i):
-                    yield True
-                else:
-                    yield False
+    def _prefix(self, net):
+        """ Convert prefix to the integer form used in the tree nodes.
+
+        :param net: IPv4/6 prefix
+        :returns: Tuple (value, length) or None when the address family \
+        does not match the tree
+        """
+        net = IPLookupTree._normalize_pfx(net)
+        if net.max_prefixlen != self.width:
+            return None
+        return (int(net.network_address), net.prefixlen)
+
+    def _common_length(self, a, b, limit):
+        """ Count leading bits two left-aligned values have in common.
+
+        :param int a: First value
+        :param int b: Second value
+        :param int limit: Maximum length to report
+        :returns: Length of the common prefix, at most limit
+        """
+        x = a ^ b
+        if not x:
+            return limit
+        return min(limit, self.width - x.bit_length())
 
     def add(self,net,data):
         """ Add node to the tree.
@@ -66,21 +91,112 @@ class IPLookupTree(object):
         :param net: IPv4/6 prefix
         :param data: Bound data (arbitrary) object
         """
-    
-        net = IPLookupTree._normalize_pfx(net)
-        bits = list(IPLookupTree._bits(net.network_address.packed))
-        index=self.root
-        for bi in range(0,net.prefixlen):
-            if bits[bi]:
-                if not index.one:
-                    index.one = _IPLookupTreeNode()
-                index = index.one
+
+        pfx = self._prefix(net)
+        if not pfx:
+            raise ValueError("Address family of %s does not match the tree" % str(net))
+        self.addInt(pfx[0], pfx[1], data)
+
+    def addInt(self, value, length, data):
+        """ Add node to the tree, prefix given in the integer form.
+
+        :param int value: Network address as int, host bits are ignored
+        :param int length: Prefix length
+        :param data: Bound data (arbitrary) object
+        """
+
+        width = self.width
+        value &= ~((1 << (width - length)) - 1)
+        index = self.root
+        while True:
+            if index.length == length:
+                index.end = True
+                index.data = data
+                return
+
+            bit = (value >> (width - 1 - index.length)) & 1
+            child = index.one if bit else index.zero
+            if not child:
+                child = _IPLookupTreeNode(value, length)
+                child.end = True
+                child.data = data
+                if bit:
+                    index.one = child
+                else:
+                    index.zero = child
+                return
+
+            common = self._common_length(child.value, value, min(child.length, length))
+            if common == child.length:
+                index = child
+                continue
+
+            # split the compressed edge and continue from the new inner node
+            split = _IPLookupTreeNode(value & ~((1 << (width - common)) - 1), common)
+            if (child.value >> (width - 1 - common)) & 1:
+                split.one = child
             else:
-                if not index.zero:
-                    index.zero = _IPLookupTreeNode()
-                index = index.zero
-        index.end = net
-        index.data = data
+                split.zero = child
+            if bit:
+                index.one = split
+            else:
+                index.zero = split
+            index = split
+
+    def remove(self, net):
+        """ Remove prefix from the tree. Meant for long-running users of a
+        tree that is updated incrementally, nfsim itself rebuilds its
+        (compacted) filters from the full prefix list.
+
+        :param net: IPv4/6 prefix
+        :returns: True when the prefix was in the tree
+        """
+
+        pfx = self._prefix(net)
+        if not pfx:
+            raise ValueError("Address family of %s does not match the tree" % str(net))
+        return self.removeInt(pfx[0], pfx[1])
+
+    def removeInt(self, value, length):
+        """ Remove prefix given in the integer form from the tree. Inner
+        nodes that are left without a prefix and with less than two children
+        are pruned, so the tree stays the same as if the prefix has never
+        been added.
+
+        :param int value: Network address as int, host bits are ignored
+        :param int length: Prefix length
+        :returns: True when the prefix was in the tree
+        """
+
+        width = self.width
+        value &= ~((1 << (width - length)) - 1)
+        path = [] # (parent, bit) of the nodes on the way down
+        index = self.root
+        while index.length < length:
+            bit = (value >> (width - 1 - index.length)) & 1
+            child = index.one if bit else index.zero
+            if not child or child.length > length or (value ^ child.value) >> (width - child.length):
+                return False
+            path.append((index, bit))
+            index = child
+
+        if index.length != length or not index.end:
+            return False
+        index.end = False
+        index.data = None
+
+        # replace the node by its only child (or nothing) up the path
+        while path and not index.end and not (index.one and index.zero):
+            (parent, bit) = path.pop()
+            rest = index.one or index.zero
+            if bit:
+                parent.one = rest
+            else:
+                parent.zero = rest
+            if rest:
+                break
+            index = parent
+        return True
 
     @staticmethod
     def _normalize_pfx(ip):
@@ -93,51 +209,50 @@ class IPLookupTree(object):
         else:
             return ipaddress.ip_network(ip)
 
-    @staticmethod
-    def _normalize_addr(ip):
-        """
-            Create IPv4Address or IPv6Address out of a supplied IPv46Network, string or address.
-        """
-        if isinstance(ip, ipaddress.IPv4Address) or isinstance(ip, ipaddress.IPv6Address):
-            return ip
-        elif isinstance(ip, ipaddress.IPv4Network) or isinstance(ip, ipaddress.IPv6Network):
-            return ip.network_address
-        else:
-            return ipaddress.ip_address(ip)
-
-    def _lookupAllLevelsNode(self, ip, maxMatches=0):
-        """ Internal match helper.
+    def _walk(self, value, limit, maxMatches=0):
+        """ Internal match helper working on the integer form.
 
-        :param ip: IPv4/6 to match
-        :param int maxMatches: Maximum matches in the return list, i.e. stop when we \
-        have #maxMatches matches and ignore more specifices. 0=Unlimited
-        :returns: List of resulting match candidate objects.
+        :param int value: Left-aligned address or prefix value to match
+        :param int limit: Prefix length of the matched value
+        :param int maxMatches: Maximum matches, 0=Unlimited
+        :returns: Iterator that yields matching nodes, least specific first
         """
-
-        ip = IPLookupTree._normalize_pfx(ip)
-        limit=ip.prefixlen
-
+        width = self.width
         index = self.root
-        # match address
-        a = IPLookupTree._normalize_addr(ip)
-        for (bi,b) in enumerate(IPLookupTree._bits(a.packed)):
-            if index.end and index.end.overlaps(ip): # match
+        matches = 0
+        while index and index.length <= limit:
+            if (value ^ index.value) >> (width - index.length):
+                # the node prefix does not cover the value
+                return
+
+            if index.end:
                 yield index
+                matches += 1
+                if maxMatches > 0 and matches >= maxMatches:
+                    return
 
-            if bi >= limit or (maxMatches > 0 and len(candidates) >= maxMatches):
-                # limit reached - either pfxlen or maxMatches
+            if index.length == width:
                 return
 
             # choose next step 1 or 0
-            if b:
+            if (value >> (width - 1 - index.length)) & 1:
                 index = index.one
             else:
                 index = index.zero
 
-            # dead end
-            if not index: 
-                return
-        # in case full IP address was matched in the tree simply finish with the last yield
+    def _lookupAllLevelsNode(self, ip, maxMatches=0):
+        """ Internal match helper.
+
+        :param ip: IPv4/6 to match
+        :param int maxMatches: Maximum matches in the return list, i.e. stop when we \
+        have #maxMatches matches and ignore more specifices. 0=Unlimited
+        :returns: Iterator of resulting match candidate nodes.
+        """
+
+        pfx = self._prefix(ip)
+        if not pfx:
+            return iter(())
+        return self._walk(pfx[0], pfx[1], maxMatches)
 
     def lookupAllLevels(self, ip, maxMatches=0):
         """ Lookup in the tree. Find all matches (i.e. all objects that
@@ -168,7 +283,7 @@ class IPLookupTree(object):
         else:
             return None
 
-    
+
     def lookupBest(self, ip):
         """ Lookup in the tree. Find the most specific match (i.e. an object that
         has some network set in a tree node and the network contains the
@@ -178,13 +293,85 @@ class IPLookupTree(object):
         :param ip: IPv4/6 to match
         :returns: Resulting data in best matching node.
         """
-        
+
         result = self.lookupAllLevels(ip)
         if result:
             return result[-1]
         else:
             return None
 
+    def _int(self, addr):
+        """ Convert packed address to the integer form.
+
+        :param addr: int or packed address (bytes)
+        :returns: int or None when the address length does not match the tree
+        """
+        if isinstance(addr, int):
+            return addr
+        if len(addr) * 8 != self.width:
+            return None
+        return int.from_bytes(addr, 'big')
+
+    def lookupAllLevelsInt(self, addr, maxMatches=0):
+        """ Lookup in the tree like lookupAllLevels, but take an address as
+        an integer (32-bit for IPv4, 128-bit for IPv6) or packed bytes, so no
+        ipaddress objects have to be constructed.
+
+        :param addr: int or packed address (bytes)
+        :param int maxMatches: Maximum matches in the return list. 0=Unlimited
+        :returns: List of resulting data in matching nodes.
+        """
+        addr = self._int(addr)
+        if addr is None:
+            return []
+        return [n.data for n in self._walk(addr, self.width, maxMatches)]
+
+    def lookupFirstInt(self, addr):
+        """ Lookup in the tree like lookupFirst, but take an address as
+        an integer or packed bytes.
+
+        :param addr: int or packed address (bytes)
+        :returns: Resulting data in first matching node.
+        """
+        result = self.lookupAllLevelsInt(addr, 1)
+        if result:
+            return result[0]
+        else:
+            return None
+
+    def lookupBestInt(self, addr):
+        """ Lookup in the tree like lookupBest, but take an address as
+        an integer or packed bytes. This is the fast path for matching
+        flows, the walk is inlined and nothing is allocated.
+
+        :param addr: int or packed address (bytes)
+        :returns: Resulting data in best matching node.
+        """
+        if not isinstance(addr, int):
+            addr = self._int(addr)
+            if addr is None:
+                return None
+
+        width = self.width
+        index = self.root
+        best = None
+        while index:
+            if (addr ^ index.value) >> (width - index.length):
+                break
+            if index.end:
+                best = index
+            if index.length == width:
+                break
+            if (addr >> (width - 1 - index.length)) & 1:
+                index = index.one
+            else:
+                index = index.zero
+
+        if best:
+            return best.data
+        else:
+            return None
+
     def lookupNetExact(self, net):
         """ Lookup in the tree. Find the exact match for a net (i.e. an object that
         has some network set in a tree node and the network contains the
@@ -195,11 +382,39 @@ class IPLookupTree(object):
         :returns: Resulting data in exact matching node.
         """
 
-        return [r.data for r in self._lookupAllLevelsNode(net) if r.end.prefixlen == ipaddress.ip_network(net).prefixlen]
+        length = IPLookupTree._normalize_pfx(net).prefixlen
+        return [r.data for r in self._lookupAllLevelsNode(net) if r.length == length]
+
+    def _network(self, node):
+        """ Reconstruct the prefix of a node.
+
+        :param node: _IPLookupTreeNode
+        :returns: IPv4Network or IPv6Network
+        """
+        if self.ipv6:
+            return ipaddress.IPv6Network((node.value, node.length))
+        else:
+            return ipaddress.IPv4Network((node.value, node.length))
+
+    def iterPrefixes(self):
+        """ Iterate over all prefixes in the tree in address order.
+
+        :returns: Iterator that yields tuples (value, length, data) where \
+        value is the integer network address
+        """
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.end:
+                yield (node.value, node.length, node.data)
+            if node.one:
+                stack.append(node.one)
+            if node.zero:
+                stack.append(node.zero)
 
     def dump(self):
         """ Dump the tree. """
-        
+
         def printSubtree(node):
             """ Print subtree of the IPLookupTree.
             :param node: Root to print (recursively)
@@ -207,10 +422,10 @@ class IPLookupTree(object):
 
             if not node:
                 return
-            
+
             if node.end:
-                print('%s %s' %(str(node.end), str(node.data)))
-                
+                print('%s %s' %(str(self._network(node)), str(node.data)))
+
             printSubtree(node.zero)
             printSubtree(node.one)
 
@@ -223,3 +438,98 @@ class IPLookupTree(object):
             return False
 
 
+def _shape(node):
+    """ Structure of the subtree for comparison of trees.
+
+    :param node: _IPLookupTreeNode or None
+    :returns: Nested tuples of the node fields
+    """
+    if not node:
+        return None
+    return (node.value, node.length, node.end, node.data, _shape(node.zero), _shape(node.one))
+
+
+def check(n=1000, seed=1):
+    """ Compare lookups in random IPv4 and IPv6 trees with matching the
+    prefixes one by one, and trees with half of the prefixes removed with
+    trees built without them.
+
+    :param int n: Number of prefixes per tree
+    :param int seed: Random seed
+    :raises AssertionError: When the tree gives a different result
+    """
+    rnd = random.Random(seed)
+    for ipv6 in (False, True):
+        width = 128 if ipv6 else 32
+        network = ipaddress.IPv6Network if ipv6 else ipaddress.IPv4Network
+        # few distinct high bits, so that the prefixes nest and share edges
+        bases = [rnd.getrandbits(width) for i in range(8)]
+
+        def address():
+            return rnd.choice(bases) ^ rnd.getrandbits(rnd.randint(0, width))
+
+        prefixes = {}
+        tree = IPLookupTree(ipv6)
+        for i in range(n):
+            length = rnd.randint(0, width)
+            value = address() & ~((1 << (width - length)) - 1)
+            prefixes[(value, length)] = i
+            tree.addInt(value, length, i)
+
+        def expected(addr):
+            return [prefixes[(v, l)] for (v, l) in sorted(prefixes, key=lambda p: p[1]) if not (addr ^ v) >> (width - l)]
+
+        for i in range(n):
+            addr = address()
+            exp = expected(addr)
+            net = network((addr, width))
+            assert tree.lookupAllLevelsInt(addr) == exp, "lookupAllLevelsInt %s" % net
+            assert tree.lookupAllLevels(net) == exp, "lookupAllLevels %s" % net
+            assert tree.lookupBestInt(addr) == (exp[-1] if exp else None), "lookupBestInt %s" % net
+            assert tree.lookupFirstInt(addr) == (exp[0] if exp else None), "lookupFirstInt %s" % net
+        assert sorted((v, l, d) for (v, l, d) in tree.iterPrefixes()) == sorted((v, l, d) for ((v, l), d) in prefixes.items()), "iterPrefixes"
+
+        removed = rnd.sample(sorted(prefixes), len(prefixes) // 2)
+        for (value, length) in removed:
+            del prefixes[(value, length)]
+            assert tree.removeInt(value, length), "removeInt %s" % network((value, length))
+            assert not tree.removeInt(value, length), "removeInt %s twice" % network((value, length))
+        fresh = IPLookupTree(ipv6)
+        for ((value, length), data) in prefixes.items():
+            fresh.addInt(value, length, data)
+        assert _shape(tree.root) == _shape(fresh.root), "tree after removal differs from a fresh tree"
+
+        for (value, length) in removed:
+            assert not tree.remove(network((value, length))), "remove %s not in the tree" % network((value, length))
+        for (value, length) in list(prefixes):
+            assert tree.remove(network((value, length))), "remove %s" % network((value, length))
+        assert _shape(tree.root) == _shape(IPLookupTree(ipv6).root), "tree not empty after removing all prefixes"
+
+
+def main():
+    def usage():
+        print("""IP lookup tree
+    %s --check [<prefixes>]
+        -h | --help
+        -c | --check -- compare lookups and removal with random prefixes against brute force
+""" % sys.argv[0])
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc", ["help", "check"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-c", "--check"):
+            check(int(args[0]) if args else 1000)
+            print("OK")
+        else:
+            assert False, "unhandled option"
+
+
+if __name__ == '__main__':
+    main()
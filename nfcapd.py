@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+# SmartValidator - simulator component
+# by Tomas Hlavacek (tmshlvck@gmail.com)
+
+"""
+Native reader for nfcapd files as written by nfdump 1.6 (LAYOUT_VERSION_1).
+
+Only uncompressed files are supported, compressed ones raise
+UnsupportedFile and the caller is expected to fall back to nfdump. Flows
+are read from the common records (type 10) in data blocks of type 2, the
+optional extensions are skipped, so every record counts as one flow.
+
+The reader can be checked against files made by write_nfcapd:
+
+    nfcapd.py --check [<records>]
+"""
+
+import sys
+import os
+import struct
+import array
+import random
+import getopt
+import tempfile
+
+NFCAPD_MAGIC = 0xA50C
+LAYOUT_VERSION_1 = 1
+
+FLAG_LZO_COMPRESSED = 0x1
+FLAG_BZ2_COMPRESSED = 0x8
+FLAG_LZ4_COMPRESSED = 0x10
+
+DATA_BLOCK_TYPE_2 = 2
+EXTENSION_MAP_TYPE = 2
+COMMON_RECORD_TYPE = 10
+
+FLAG_IPV6_ADDR = 0x1
+FLAG_PKG_64 = 0x2
+FLAG_BYTES_64 = 0x4
+
+# magic, version, flags, NumBlocks, ident
+file_header = struct.Struct('<HHII128s')
+# numflows .. numpackets_other (15x), first_seen, last_seen, msec_first, msec_last, sequence_failure
+stat_record = struct.Struct('<15QIIHHI')
+# NumRecords, size, id, flags
+block_header = struct.Struct('<IIHH')
+# type, size
+record_header = struct.Struct('<HH')
+# type, size, flags, ext_map, msec_first, msec_last, first, last,
+# fwd_status, tcp_flags, prot, tos, srcport, dstport, exporter_sysid, biFlowDir, flowEndReason
+common_record = struct.Struct('<HHHHHHIIBBBBHHHBB')
+ipv4_block = struct.Struct('<II')
+counter32 = struct.Struct('<I')
+counter64 = struct.Struct('<Q')
+
+# columns yielded by read_blocks(), same order as the records of nfsim
+columns = ('date', 'duration', 'protocol', 'src', 'srcport', 'dst', 'dstport', 'packets', 'bytes', 'flows')
+column_types = ('d', 'd', 'B', 'I', 'H', 'I', 'H', 'Q', 'Q', 'I')
+
+
+class UnsupportedFile(Exception):
+    """ The file is not an nfcapd file this reader can handle. """
+    pass
+
+
+def read_header(fh):
+    """ Read and check file header and stat record.
+
+    :param fh: File opened in binary mode
+    :returns: Number of data blocks
+    """
+    (magic, version, flags, blocks, ident) = file_header.unpack(fh.read(file_header.size))
+    if magic != NFCAPD_MAGIC or version != LAYOUT_VERSION_1:
+        raise UnsupportedFile("Not an nfcapd file of layout version 1")
+    if flags & (FLAG_LZO_COMPRESSED | FLAG_BZ2_COMPRESSED | FLAG_LZ4_COMPRESSED):
+        raise UnsupportedFile("Compressed nfcapd file")
+    fh.read(stat_record.size)
+    return blocks
+
+
+def is_supported(filename):
+    """ Check whether the file can be read by this module.
+
+    :param str filename: nfcapd file name
+    :returns: bool
+    """
+    try:
+        with open(filename, 'rb') as fh:
+            read_header(fh)
+        return True
+    except (UnsupportedFile, OSError, struct.error):
+        return False
+
+
+def decode_block(data, count, stats=None):
+    """ Decode data block into fixed-width column arrays.
+
+    :param bytes data: Block data without the block header
+    :param int count: Number of records in the block
+    :param dict stats: Optional dict, IPv6 flows are counted in stats['ipv6']
+    :returns: dict column name -> array.array
+    """
+    cols = [array.array(t) for t in column_types]
+    (date, duration, proto, src, srcport, dst, dstport, packets, nbytes, flows) = cols
+
+    offset = 0
+    for i in range(count):
+        (rtype, rsize) = record_header.unpack_from(data, offset)
+        if rsize == 0:
+            break
+        if rtype == COMMON_RECORD_TYPE:
+            r = common_record.unpack_from(data, offset)
+            rflags = r[2]
+            if rflags & FLAG_IPV6_ADDR:
+                if stats is not None:
+                    stats['ipv6'] = stats.get('ipv6', 0) + 1
+            else:
+                p = offset + common_record.size
+                (sa, da) = ipv4_block.unpack_from(data, p)
+                p += ipv4_block.size
+                if rflags & FLAG_PKG_64:
+                    (pkts,) = counter64.unpack_from(data, p)
+                    p += counter64.size
+                else:
+                    (pkts,) = counter32.unpack_from(data, p)
+                    p += counter32.size
+                if rflags & FLAG_BYTES_64:
+                    (byts,) = counter64.unpack_from(data, p)
+                else:
+                    (byts,) = counter32.unpack_from(data, p)
+
+                date.append((r[6] * 1000 + r[4]) / 1000.0)
+                duration.append(((r[7] - r[6]) * 1000 + r[5] - r[4]) / 1000.0)
+                proto.append(r[10])
+                src.append(sa)
+                srcport.append(r[12])
+                dst.append(da)
+                dstport.append(r[13])
+                packets.append(pkts)
+                nbytes.append(byts)
+                flows.append(1)
+        offset += rsize
+
+    return dict(zip(columns, cols))
+
+
+def read_blocks(filename, stats=None, offset=None, blocks=None):
+    """ Read nfcapd file block by block.
+
+    :param str filename: nfcapd file name
+    :param dict stats: Optional dict for counters of skipped flows
+    :param int offset: Optional file offset of the first block to read, \
+    see block_ranges()
+    :param int blocks: Number of blocks to read from offset
+    :returns: Iterator that yields dict column name -> array.array per block
+    """
+    with open(filename, 'rb') as fh:
+        total = read_header(fh)
+        if offset is not None:
+            fh.seek(offset)
+            total = blocks
+        for b in range(total):
+            hdr = fh.read(block_header.size)
+            if len(hdr) < block_header.size:
+                break
+            (count, size, bid, bflags) = block_header.unpack(hdr)
+            data = fh.read(size)
+            if bid != DATA_BLOCK_TYPE_2:
+                continue
+            yield decode_block(data, count, stats)
+
+
+def block_ranges(filename, size):
+    """ Split the file into consecutive ranges of blocks of about size bytes \
+    that can be read independently.
+
+    :param str filename: nfcapd file name
+    :param int size: Target size of a range in bytes
+    :returns: List of (offset, blocks) for read_blocks()
+    """
+    ranges = []
+    with open(filename, 'rb') as fh:
+        total = read_header(fh)
+        start = fh.tell()
+        count = 0
+        for b in range(total):
+            hdr = fh.read(block_header.size)
+            if len(hdr) < block_header.size:
+                break
+            (records, bsize, bid, bflags) = block_header.unpack(hdr)
+            fh.seek(bsize, 1)
+            count += 1
+            if fh.tell() - start >= size:
+                ranges.append((start, count))
+                start = fh.tell()
+                count = 0
+    if count or not ranges:
+        ranges.append((start, count))
+    return ranges
+
+
+def read_records(filename, stats=None):
+    """ Read nfcapd file record by record.
+
+    :param str filename: nfcapd file name
+    :param dict stats: Optional dict for counters of skipped flows
+    :returns: Iterator that yields tuples in the order of columns, \
+    date is float UNIX timestamp of the flow start
+    """
+    for block in read_blocks(filename, stats):
+        yield from zip(*(block[c] for c in columns))
+
+
+def write_nfcapd(filename, records, ident=b'nfsim', block_records=1000):
+    """ Write uncompressed nfcapd file, mostly for generating test data.
+
+    :param str filename: Output file name
+    :param records: Iterable of tuples in the order of columns (IPv4 only, \
+    date as float UNIX timestamp, flows is ignored)
+    :param bytes ident: File ident string
+    :param int block_records: Maximum records per data block
+    """
+    # extension map with no optional extensions, aligned to 4 bytes
+    extmap = struct.pack('<HHHHH2x', EXTENSION_MAP_TYPE, 12, 0, 0, 0)
+
+    blocks = []
+    block = [extmap]
+    count = 1
+    for r in records:
+        (date, duration, proto, src, srcport, dst, dstport, pkts, byts) = r[:9]
+        (first, msec_first) = divmod(int(round(date * 1000)), 1000)
+        (last, msec_last) = divmod(int(round((date + duration) * 1000)), 1000)
+
+        rflags = 0
+        tail = ipv4_block.pack(src, dst)
+        if pkts > 0xffffffff:
+            rflags |= FLAG_PKG_64
+            tail += counter64.pack(pkts)
+        else:
+            tail += counter32.pack(pkts)
+        if byts > 0xffffffff:
+            rflags |= FLAG_BYTES_64
+            tail += counter64.pack(byts)
+        else:
+            tail += counter32.pack(byts)
+
+        size = common_record.size + len(tail)
+        block.append(common_record.pack(COMMON_RECORD_TYPE, size, rflags, 0, msec_first, msec_last, first, last, 0, 0, proto, 0, srcport, dstport, 0, 0, 0) + tail)
+        count += 1
+        if count >= block_records:
+            blocks.append((count, b''.join(block)))
+            block = []
+            count = 0
+    if count:
+        blocks.append((count, b''.join(block)))
+
+    with open(filename, 'wb') as fh:
+        fh.write(file_header.pack(NFCAPD_MAGIC, LAYOUT_VERSION_1, 0, len(blocks), ident))
+        fh.write(bytes(stat_record.size))
+        for (count, data) in blocks:
+            fh.write(block_header.pack(count, len(data), DATA_BLOCK_TYPE_2, 0))
+            fh.write(data)
+
+
+def random_records(n, seed=0):
+    """ Generate n random IPv4 flow records for write_nfcapd.
+
+    :param int n: Number of records
+    :param int seed: Random seed
+    :returns: List of tuples in the order of columns
+    """
+    rnd = random.Random(seed)
+    records = []
+    for i in range(n):
+        # some counters do not fit 32 bits
+        big = rnd.random() < 0.05
+        records.append((1513411200 + rnd.randrange(300000) / 1000.0, rnd.randrange(60000) / 1000.0, rnd.choice((1, 6, 17, 47)),
+            rnd.getrandbits(32), rnd.getrandbits(16), rnd.getrandbits(32), rnd.getrandbits(16),
+            rnd.getrandbits(40) if big else rnd.randrange(1, 1000), rnd.getrandbits(48) if big else rnd.randrange(40, 1500000), 1))
+    return records
+
+
+def check(n=10000, block_records=1000):
+    """ Write n random records with write_nfcapd and check that read_records
+    returns them and that the ranges of block_ranges cover all blocks.
+
+    :param int n: Number of records
+    :param int block_records: Maximum records per data block
+    :raises AssertionError: When the files do not round-trip
+    """
+    records = random_records(n)
+    (fd, fn) = tempfile.mkstemp(prefix='nfcapd_check_')
+    os.close(fd)
+    try:
+        write_nfcapd(fn, records, block_records=block_records)
+        stats = {}
+        got = list(read_records(fn, stats))
+        assert len(got) == len(records), "read %d records of %d" % (len(got), len(records))
+        for (r, g) in zip(records, got):
+            assert r[2:] == g[2:], "record %s read as %s" % (r, g)
+            assert abs(r[0] - g[0]) < 0.001 and abs(r[1] - g[1]) < 0.002, "time of %s read as %s" % (r, g)
+        assert not any(stats.values()), "skipped flows %s" % stats
+
+        with open(fn, 'rb') as fh:
+            total = read_header(fh)
+        for size in (1, 4096, 100000, os.path.getsize(fn)):
+            ranges = block_ranges(fn, size)
+            assert sum(b for (o, b) in ranges) == total, "ranges of %d bytes cover %d of %d blocks" % (size, sum(b for (o, b) in ranges), total)
+            parts = [r for (offset, blocks) in ranges for block in read_blocks(fn, None, offset, blocks) for r in zip(*(block[c] for c in columns))]
+            assert parts == got, "ranges of %d bytes read different records" % size
+    finally:
+        os.remove(fn)
+
+
+def main():
+    def usage():
+        print("""Native nfcapd reader
+    %s --check [<records>]
+        -h | --help
+        -c | --check -- round-trip generated records through write_nfcapd and the reader
+""" % sys.argv[0])
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc", ["help", "check"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-c", "--check"):
+            n = int(args[0]) if args else 10000
+            check(n)
+            check(n // 10 + 1, block_records=7)
+            print("OK")
+        else:
+            assert False, "unhandled option"
+
+
+if __name__ == '__main__':
+    main()
@@ -7,10 +7,33 @@
 debug=1
 status_file='/tmp/smartvalidator_sim'
 lock_file='/tmp/smartvalidator_lock'
+# files processed ahead of the oldest unfinished one, see write_report
+schedule_window=256
+# seconds after which a lock file without pid is considered stale
+lock_grace=60
+# per-router record of finished files, see Journal
+journal_dir='/tmp/smartvalidator_journal'
+# failed attempts after which the watch mode gives up a file, see run_daemon
+max_attempts=3
+# compiled filter is kept next to the prefix list, see read_filter_prefixes()
+compiled_filter_suffix='.compiled'
 
 ports = [80,443,25,110,143,53]
 protocols = [6,17]
 
+# records matched at once by the numpy batch path
+chunk_size = 65536
+
+# state of a pool worker process, set once by init_worker()
+# list of SimFilter
+worker_filters = []
+worker_outdir = None
+# (candidate filter file, rest filter file) when matching is pushed down to nfdump
+worker_pushdown = None
+worker_fast_parser = False
+worker_native = False
+worker_flowcache = None
+
 import sys
 import os
 import datetime
@@ -22,6 +45,40 @@ import iptree
 import ipaddress
 import multiprocessing
 import os.path
+import socket
+import functools
+import hashlib
+import struct
+import array
+import time
+import signal
+import itertools
+import heapq
+import collections
+import shutil
+import io
+import gzip
+import math
+import queue
+
+try:
+    import ipbatch
+    import flowcache
+    import numpy
+except ImportError:
+    ipbatch = None
+    flowcache = None
+    numpy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import nfcapd
+import topk
+import hll
+import rollup
 
 def dbg(text):
     if debug:
@@ -76,34 +133,343 @@ def read_status(filename=status_file):
     return datetime.datetime(1970,1,1,0,0)
 
 
-def find_files(rootdir):
-    for root, dirs, files in os.walk(rootdir):
-        for name in files:
-            fn = os.path.abspath(os.path.join(root, name))
-            try:
-                decode_nfdump_time(fn)
-            except:
-                pass
-            else:
-                yield fn
+class Journal(object):
+    """
+        Durable per-router record of finished nfcapd files, so that a
+        restart resumes exactly where the previous run stopped. Each router
+        has a file in dirname with a line "checkpoint <UNIX time>" (all
+        files up to that time are finished) followed by "done <UNIX time>"
+        lines of files that finished out of order ("failed <UNIX time>" of
+        files given up, see fail). The global status_file is kept at the
+        oldest router checkpoint.
+    """
 
+    def __init__(self, dirname=journal_dir, statusfn=status_file):
+        self.dirname = dirname
+        self.statusfn = statusfn
+        # router -> datetime of checkpoint
+        self.checkpoints = {}
+        # router -> set of datetime of files finished after checkpoint
+        self.done = {}
+        # router -> deque of datetime of started files in time order
+        self.pending = {}
+        # checkpoint of routers not seen in the journal yet
+        self.default = read_status(statusfn)
+
+        os.makedirs(dirname, exist_ok=True)
+        for router in os.listdir(dirname):
+            if router.startswith('.'):
+                continue
+            self.done[router] = set()
+            with open(os.path.join(dirname, router), 'r') as fh:
+                for l in fh:
+                    try:
+                        (kind, ts) = l.split()
+                        t = datetime.datetime.fromtimestamp(int(ts))
+                    except ValueError:
+                        # torn last line after crash
+                        continue
+                    if kind == 'checkpoint':
+                        self.checkpoints[router] = t
+                    else:
+                        self.done[router].add(t)
+            self.checkpoints.setdefault(router, self.default)
+
+    def oldest(self):
+        """
+            The oldest checkpoint, no file older than this needs processing.
+        """
+        return min(self.checkpoints.values(), default=self.default)
+
+    def is_done(self, fn):
+        router = decode_hostname(fn)
+        t = decode_nfdump_time(fn)
+        return t <= self.checkpoints.get(router, self.default) or t in self.done.get(router, ())
+
+    def start(self, fn):
+        """
+            Note that fn is going to be processed. Files of each router
+            have to be started in time order.
+        """
+        self.pending.setdefault(decode_hostname(fn), collections.deque()).append(decode_nfdump_time(fn))
+
+    def finish(self, fn):
+        """
+            Record fn as finished and move the router checkpoint over all
+            files finished so far without a gap.
+        """
+        router = decode_hostname(fn)
+        t = decode_nfdump_time(fn)
+        pending = self.pending[router]
+        done = self.done.setdefault(router, set())
+        if pending[0] != t:
+            done.add(t)
+            self._append(router, 'done %d\n' % int(t.timestamp()))
+            return
+
+        pending.popleft()
+        checkpoint = t
+        while pending and pending[0] in done:
+            checkpoint = pending.popleft()
+        done.difference_update([d for d in done if d <= checkpoint])
+        self.checkpoints[router] = checkpoint
+        self._rewrite(router)
+        write_status(self.oldest(), self.statusfn)
+
+    def fail(self, fn):
+        """
+            Give up fn that can not be processed, it is skipped like a
+            finished file so that the checkpoint can move over it. fn must
+            not be pending.
+        """
+        router = decode_hostname(fn)
+        t = decode_nfdump_time(fn)
+        self.done.setdefault(router, set()).add(t)
+        self._append(router, 'failed %d\n' % int(t.timestamp()))
+
+    def _append(self, router, line):
+        with open(os.path.join(self.dirname, router), 'a') as fh:
+            fh.write(line)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def _rewrite(self, router):
+        fn = os.path.join(self.dirname, router)
+        tmpfn = os.path.join(self.dirname, '.%s.%d' % (router, os.getpid()))
+        with open(tmpfn, 'w') as fh:
+            fh.write('checkpoint %d\n' % int(self.checkpoints[router].timestamp()))
+            for d in sorted(self.done[router]):
+                fh.write('done %d\n' % int(d.timestamp()))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmpfn, fn)
+
+
+class FileError(Exception):
+    """
+        Processing of the nfcapd file filename failed.
+    """
 
-def read_filter(fltrfn):
+    def __init__(self, filename, error):
+        Exception.__init__(self, "%s: %s" % (filename, error))
+        self.filename = filename
+
+
+def find_files(rootdir, latest_point=None):
+    """
+        Yield nfcapd files under rootdir newer than latest_point in time
+        order. Expects NFSen SUBDIRLAYOUT 1 (host/YYYY/MM/DD/nfcapd.*),
+        year, month and day directories older than latest_point are not
+        scanned at all.
+    """
+    return (fn for (t, fn) in scan_files(os.path.abspath(rootdir), latest_point))
+
+
+def decode_date_dir(name, depth):
+    """
+        Year, month or day (by depth) of the layout directory name or None.
+    """
+    if depth < 3 and name.isdigit() and len(name) == (4 if depth == 0 else 2):
+        return int(name)
+    return None
+
+
+def scan_files(path, latest_point=None, date=()):
+    """
+        Yield (time, file name) under path in time order. date is the
+        (year, month, day) prefix of path in the directory layout.
+    """
+    if latest_point:
+        limit = (latest_point.year, latest_point.month, latest_point.day)
+    files = []
+    dated = []
+    streams = []
+    with os.scandir(path) as it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                d = decode_date_dir(e.name, len(date))
+                if d is None:
+                    # host or other directory, has its own time line
+                    streams.append(scan_files(e.path, latest_point))
+                elif not latest_point or date + (d,) >= limit[:len(date) + 1]:
+                    dated.append((d, e.path))
+            elif e.is_file():
+                try:
+                    t = decode_nfdump_time(e.path)
+                except:
+                    continue
+                if not latest_point or t > latest_point:
+                    files.append((t, e.path))
+
+    # date directories do not overlap, scan them lazily one after another
+    dated.sort()
+    streams.append(itertools.chain.from_iterable(scan_files(dp, latest_point, date + (d,)) for (d, dp) in dated))
+    files.sort()
+    streams.append(files)
+    yield from heapq.merge(*streams)
+
+
+def parse_filter(lines):
+    """
+        Parse text prefix list, yield (value, length) of IPv4 prefixes.
+    """
+    for l in lines:
+        try:
+            ipa = ipaddress.IPv4Network(l.strip())
+            yield (int(ipa.network_address), ipa.prefixlen)
+        except:
+            print("Ignoring line %s" % l)
+
+
+# magic, format version, SHA-256 of the source prefix list, prefix count
+compiled_filter_header = struct.Struct('<4sH32sI')
+
+
+def save_compiled_filter(filename, digest, prefixes):
+    """
+        Write prefixes to the compiled filter file: header followed by
+        uint32 network addresses and uint8 prefix lengths (little endian).
+    """
+    values = array.array('I', [v for (v, l) in prefixes])
+    lengths = array.array('B', [l for (v, l) in prefixes])
+    if sys.byteorder != 'little':
+        values.byteswap()
+
+    tmpfn = '%s.%d' % (filename, os.getpid())
+    with open(tmpfn, 'wb') as fh:
+        fh.write(compiled_filter_header.pack(b'SVCF', 1, digest, len(prefixes)))
+        values.tofile(fh)
+        lengths.tofile(fh)
+    os.replace(tmpfn, filename)
+
+
+def load_compiled_filter(filename, digest):
+    """
+        Read compiled filter file, return list of (value, length) or None
+        when the file is missing or it was compiled from a different source.
+    """
+    try:
+        with open(filename, 'rb') as fh:
+            (magic, version, fdigest, count) = compiled_filter_header.unpack(fh.read(compiled_filter_header.size))
+            if magic != b'SVCF' or version != 1 or fdigest != digest:
+                return None
+            values = array.array('I')
+            values.fromfile(fh, count)
+            lengths = array.array('B')
+            lengths.fromfile(fh, count)
+    except (OSError, EOFError, struct.error):
+        return None
+
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return list(zip(values, lengths))
+
+
+def read_filter_prefixes(fltrfn):
+    """
+        Load the prefix list as sorted list of (value, length). The parsed
+        list is cached in <fltrfn>.compiled keyed by SHA-256 of the source,
+        so the text is parsed only when it changes.
+    """
+    with open(fltrfn, 'rb') as fh:
+        src = fh.read()
+    digest = hashlib.sha256(src).digest()
+    cfn = fltrfn + compiled_filter_suffix
+
+    prefixes = load_compiled_filter(cfn, digest)
+    if prefixes is None:
+        prefixes = sorted(set(parse_filter(src.decode('ascii', 'replace').splitlines(True))))
+        try:
+            save_compiled_filter(cfn, digest, prefixes)
+        except OSError as e:
+            print("Can not write compiled filter %s: %s" % (cfn, e))
+    else:
+        dbg("loaded compiled filter %s" % cfn)
+    return prefixes
+
+
+def range_prefixes(start, end):
+    """
+        Minimal list of IPv4 (value, length) covering addresses start
+        to end (exclusive).
+    """
+    res = []
+    while start < end:
+        size = (start & -start) if start else (1 << 32)
+        while size > end - start:
+            size >>= 1
+        res.append((start, 33 - size.bit_length()))
+        start += size
+    return res
+
+
+def compact_prefixes(prefixes):
+    """
+        Collapse prefixes (list of IPv4 (value, length)) to the minimal
+        list covering the same addresses: prefixes covered by others are
+        dropped and adjacent ones merged. Good for filters that only
+        answer whether an address is covered, not by which prefix.
+    """
+    res = []
+    start = end = None
+    for (v, l) in sorted(prefixes):
+        last = v + (1 << (32 - l))
+        if end is not None and v <= end:
+            end = max(end, last)
+            continue
+        if end is not None:
+            res.extend(range_prefixes(start, end))
+        (start, end) = (v, last)
+    if end is not None:
+        res.extend(range_prefixes(start, end))
+    return res
+
+
+def build_attribution(prefixes):
+    """
+        Tree of prefixes that gives the prefix string of the best match.
+    """
     t = iptree.IPLookupTree(ipv6=False)
-    with open(fltrfn, 'r') as fh:
-        for l in fh:
-            try:
-                ipa = ipaddress.IPv4Network(l.strip())
-                t.add(ipa, True)
-            except:
-                print("Ignoring line %s" % l)
+    for (v, l) in prefixes:
+        t.addInt(v, l, '%s/%d' % (int_to_addr(v), l))
     return t
 
 
-def process_nfdump_output(stdout):
+def build_filter(prefixes):
+    t = iptree.IPLookupTree(ipv6=False)
+    for (v, l) in prefixes:
+        t.addInt(v, l, True)
+    return t
+
+
+def read_filter(fltrfn):
+    return build_filter(read_filter_prefixes(fltrfn))
+
+
+def addr_to_int(addr):
+    """
+        Convert dotted IPv4 address string to int without building ipaddress objects.
+    """
+    return int.from_bytes(socket.inet_aton(addr), 'big')
+
+
+def int_to_addr(addr):
+    """
+        Convert int IPv4 address back to the dotted string.
+    """
+    return socket.inet_ntoa(int(addr).to_bytes(4, 'big'))
+
+
+def process_nfdump_output(stdout, intaddr=False):
+    """
+        Parse nfdump text output. With intaddr the src and dst addresses
+        are emitted as ints suitable for IPLookupTree.lookupBestInt.
+    """
     def splitipport(ipport):
         g=ipport.split(':')
         if len(g) == 2:
+            if intaddr:
+                return (addr_to_int(g[0]), int(g[1]))
             return (g[0], int(g[1]))
         else:
             raise Exception("Can not split address and port %s" % ipport)
@@ -126,102 +492,952 @@ def process_nfdump_output(stdout):
             yield r
 
 
-def process_records(records, fltr, srcfilename, outdir):
-    header = ['date', 'duration', 'protocol', 'src', 'srcport', 'dst', 'dstport', 'packets', 'bytes', 'flows']
+# machine readable nfdump output consumed by process_nfdump_csv()
+nfdump_csv_format = 'fmt:%ts,%td,%pr,%sa,%sp,%da,%dp,%pkt,%byt,%fl'
+# protocol names printed by nfdump for %pr, other names are looked up in
+# the system protocol database by protocol_number()
+nfdump_protocols = {'ICMP': 1, 'IGMP': 2, 'GGP': 3, 'IPIP': 4, 'ST': 5, 'TCP': 6, 'CBT': 7, 'EGP': 8, 'IGP': 9, 'UDP': 17,
+    'IPv6': 41, 'RSVP': 46, 'GRE': 47, 'ESP': 50, 'AH': 51, 'ICMP6': 58, 'EIGRP': 88, 'OSPF': 89, 'ETHIP': 97,
+    'PIM': 103, 'VRRP': 112, 'L2TP': 115, 'ISIS': 124, 'SCTP': 132}
+# protocol number for names nobody knows, counted in the other protocols
+unknown_protocol = 255
 
-    drop_proto_packets = {p:0 for p in (protocols + [None])}
-    accept_proto_packets = {p:0 for p in (protocols + [None])}
-    drop_proto_bytes = {p:0 for p in (protocols + [None])}
-    accept_proto_bytes = {p:0 for p in (protocols + [None])}
 
-    drop_port_packets = {p:0 for p in (ports + [None])}
-    accept_port_packets = {p:0 for p in (ports + [None])}
-    drop_port_bytes = {p:0 for p in (ports + [None])}
-    accept_port_bytes = {p:0 for p in (ports + [None])}
+def protocol_number(name, stats=None):
+    """
+        Protocol number of nfdump protocol name. Names missing from
+        nfdump_protocols are resolved by socket.getprotobyname and
+        remembered, unknown names give unknown_protocol and are counted in
+        stats['unknown_protocol'].
+    """
+    for n in (name, name.lower(), name.upper()):
+        try:
+            p = socket.getprotobyname(n)
+            break
+        except OSError:
+            pass
+    else:
+        p = unknown_protocol
+        if stats is not None:
+            stats['unknown_protocol'] = stats.get('unknown_protocol', 0) + 1
+        return p
+    nfdump_protocols[name] = p
+    return p
 
-    def update(table, key, value):
-        if key in table:
-            table[key] += value
-        else:
-            table[None] += value
 
-    ofh = None
-    ofw = None
-    if outdir:
-        ofh = open(os.path.join(outdir, '%s.csv' % srcfilename), 'w')
-        ofw = csv.writer(ofh, quoting=csv.QUOTE_MINIMAL)
-        ofw.writerow(header)
+def parse_nfdump_time(ts):
+    """
+        Cheap replacement for strptime of '2017-12-16 09:00:01.123'.
+    """
+    msec = 0
+    if len(ts) > 20:
+        msec = int(ts[20:23])
+    return datetime.datetime(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]), int(ts[11:13]), int(ts[14:16]), int(ts[17:19]), msec * 1000)
+
+
+def process_nfdump_csv(stdout, stats=None, blocksize=1<<20):
+    """
+        Parse output of nfdump -q -o nfdump_csv_format. The pipe is read
+        in large blocks and addresses are emitted as ints. The date is kept
+        as the string from nfdump and it is converted only when the record
+        is written out (see format_record). Lines that can not be parsed
+        are counted in stats['malformed'], IPv6 flows in stats['ipv6'],
+        see protocol_number for unknown protocol names.
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault('malformed', 0)
+    stats.setdefault('ipv6', 0)
+
+    def proto(p):
+        p = p.strip()
+        if p.isdigit():
+            return int(p)
+        try:
+            return nfdump_protocols[p]
+        except KeyError:
+            return protocol_number(p, stats)
+
+    def port(p):
+        try:
+            return int(p)
+        except ValueError:
+            # ICMP type.code, the same word as in nfcapd files
+            (t, c) = p.split('.')
+            return (int(t) << 8) | int(c)
+
+    tail = b''
+    while True:
+        block = stdout.read(blocksize)
+        lines = (tail + block).split(b'\n')
+        # the last line without newline is parsed at the end of the output
+        tail = lines.pop() if block else b''
+        for l in lines:
+            c = l.decode('ascii', 'replace').split(',')
+            try:
+                yield (c[0].strip(), float(c[1]), proto(c[2]), addr_to_int(c[3].strip()), port(c[4]), addr_to_int(c[5].strip()), port(c[6]), int(c[7]), int(c[8]), int(c[9]))
+            except (IndexError, ValueError, OSError):
+                if len(c) > 3 and ':' in c[3]:
+                    stats['ipv6'] += 1
+                elif l.strip():
+                    stats['malformed'] += 1
+        if not block:
+            break
+
 
+# columns of a flow record, also the header of the per-flow CSV
+record_columns = ['date', 'duration', 'protocol', 'src', 'srcport', 'dst', 'dstport', 'packets', 'bytes', 'flows']
+
+
+def format_record(r):
+    """
+        Convert record with int addresses to the row written to per-flow CSV.
+        The date may come as datetime, nfdump time string or UNIX timestamp.
+    """
+    dt = r[0]
+    if isinstance(dt, str):
+        dt = parse_nfdump_time(dt)
+    elif isinstance(dt, (int, float)):
+        dt = datetime.datetime.fromtimestamp(dt)
+    return (dt,) + tuple(r[1:3]) + (int_to_addr(r[3]), r[4], int_to_addr(r[5])) + tuple(r[6:])
+
+
+def record_timestamp(dt):
+    """
+        Convert record date (datetime, nfdump time string or UNIX timestamp)
+        to UNIX timestamp.
+    """
+    if isinstance(dt, str):
+        dt = parse_nfdump_time(dt)
+    if isinstance(dt, datetime.datetime):
+        return dt.timestamp()
+    return float(dt)
+
+
+def chunk_records(records, size=chunk_size):
+    """
+        Group records into chunks of columns: dict column name -> sequence,
+        the form in which flow sources hand the flows to process_chunks.
+    """
+    chunk = []
     for r in records:
-        if fltr.lookupBest(r[3]) and not fltr.lookupBest(r[5]): # ROV is dropping the flow
-            if ofw:
-                ofw.writerow(r)
+        chunk.append(r)
+        if len(chunk) >= size:
+            yield dict(zip(record_columns, zip(*chunk)))
+            chunk = []
+    if chunk:
+        yield dict(zip(record_columns, zip(*chunk)))
+
+
+def chunk_rows(chunk):
+    """
+        Iterate over records (tuples) of a chunk. Array columns are
+        converted to lists first to get plain Python values.
+    """
+    return zip(*(chunk[c].tolist() if hasattr(chunk[c], 'tolist') else chunk[c] for c in record_columns))
+
+
+def make_verdict_cache(fltr, size):
+    """
+        Wrap fltr.lookupBestInt in a bounded LRU cache of address verdicts.
+        Hit/miss counters are available through cache_info().
+    """
+    return functools.lru_cache(maxsize=size)(fltr.lookupBestInt)
+
+
+class SimFilter(object):
+    """ Filter evaluated by process_chunks_multi. Flows are matched with
+    batch (ipbatch.IPIntervalSet) when it is set, otherwise flow by flow
+    with lookup (fltr.lookupBestInt or its cache). With attrib and
+    topk_size the dropped traffic is attributed to the filter prefixes in
+    top-k summary. """
+    def __init__(self, name, fltr=None, batch=None, lookup=None, attrib=None, topk_size=0):
+        """
+        :param str name: Filter name for the report, None for the single unnamed filter
+        :param fltr: iptree.IPLookupTree or None when batch is used
+        :param batch: ipbatch.IPIntervalSet or None
+        :param lookup: Lookup function, fltr.lookupBestInt by default
+        :param attrib: iptree.IPLookupTree of the original (not compacted) \
+        prefixes with the prefix string as data, see build_attribution
+        :param int topk_size: Number of prefixes kept in the top-k summary
+        """
+        self.name = name
+        self.fltr = fltr
+        self.batch = batch
+        if not lookup and not batch:
+            lookup = fltr.lookupBestInt
+        self.lookup = lookup
+        self.attrib = attrib
+        self.topk_size = topk_size
+
+
+class CounterTable(object):
+    """
+        Layout of the counters of one file and filter. The counters are
+        a flat array of integers, the drop part followed by the accept part,
+        each with packets and bytes per tracked protocol and then packets
+        and bytes per tracked port. The last slot of every group is for the
+        other protocols/ports. Protocols and ports are mapped to slots by
+        precomputed tables so that a flow is counted without lookups in
+        dicts.
+    """
+
+    def __init__(self, ports, protocols, distinct=False, sample=1):
+        self.ports = list(ports)
+        self.protocols = list(protocols)
+        # estimates of distinct dropped sources, destinations and prefixes
+        self.distinct = distinct
+        # 1 of sample flows is processed, see sample_chunks
+        self.sample = sample
+        self.protocol_slot = array.array('I', [len(self.protocols)]) * 256
+        for (i, p) in enumerate(self.protocols):
+            self.protocol_slot[p] = i
+        self.port_slot = array.array('I', [len(self.ports)]) * 65536
+        for (i, p) in enumerate(self.ports):
+            self.port_slot[p] = i
+
+        # offsets of the groups in the drop part
+        self.proto_packets = 0
+        self.proto_bytes = len(self.protocols) + 1
+        self.port_packets = 2 * (len(self.protocols) + 1)
+        self.port_bytes = self.port_packets + len(self.ports) + 1
+        # offset of the accept part
+        self.accept = self.port_bytes + len(self.ports) + 1
+
+    def new(self, typecode='q'):
+        return array.array(typecode, [0]) * (2 * self.accept)
+
+    def count_flow(self, c, drop, r):
+        """
+            Add record r to the drop or accept part of counters c.
+        """
+        base = 0 if drop else self.accept # ROV is dropping / accepting the flow
+        ps = base + self.protocol_slot[r[2]]
+        c[ps + self.proto_packets] += r[7]
+        c[ps + self.proto_bytes] += r[8]
+
+        ps = base + self.port_slot[r[4]]
+        c[ps + self.port_packets] += r[7]
+        c[ps + self.port_bytes] += r[8]
+
+        if r[4] != r[6]:
+            ps = base + self.port_slot[r[6]]
+            c[ps + self.port_packets] += r[7]
+            c[ps + self.port_bytes] += r[8]
+
+    def count_bulk(self, c, drop, proto, srcport, dstport, packets, nbytes):
+        """
+            Add chunk of flows given as numpy columns to counters c, drop
+            is the mask of dropped flows.
+        """
+        v = numpy.frombuffer(c, dtype=c.typecode)
+        base = numpy.where(drop, 0, self.accept)
+        port_slot = numpy.frombuffer(self.port_slot, dtype=numpy.uintc)
+
+        ps = base + numpy.frombuffer(self.protocol_slot, dtype=numpy.uintc)[proto]
+        numpy.add.at(v, ps + self.proto_packets, packets)
+        numpy.add.at(v, ps + self.proto_bytes, nbytes)
+
+        ps = base + port_slot[srcport]
+        numpy.add.at(v, ps + self.port_packets, packets)
+        numpy.add.at(v, ps + self.port_bytes, nbytes)
+
+        sel = srcport != dstport
+        ps = base[sel] + port_slot[dstport[sel]]
+        numpy.add.at(v, ps + self.port_packets, packets[sel])
+        numpy.add.at(v, ps + self.port_bytes, nbytes[sel])
+
+    def header(self):
+        """
+            Report column names of the counters.
+        """
+        cols = []
+        for action in ('drop', 'accept'):
+            for (unit, kind, keys) in (('packets', 'proto', self.protocols), ('bytes', 'proto', self.protocols), ('packets', 'port', self.ports), ('bytes', 'port', self.ports)):
+                cols += ['%s_%s_%s_%d' % (action, unit, kind, k) for k in keys] + ['%s_%s_%s_other' % (action, unit, kind)]
+        return cols
+
+    def report_header(self):
+        """
+            Report column names of the counters and the distinct estimates.
+            Sampled counters are followed by the half-widths of their 95%
+            confidence intervals.
+        """
+        cols = self.header()
+        if self.sample > 1:
+            cols = [x for col in cols for x in (col, col + '_ci95')]
+        return cols + (list(rollup.estimate_columns) if self.distinct else [])
+
+    def values(self, report):
+        """
+            Report column values of report (time, counters, sketches),
+            see report_header.
+        """
+        vals = report[1].tolist()
+        if self.sample > 1:
+            bounds = report[2]['variance'].bounds(self.sample)
+            vals = [x for (v, b) in zip(vals, bounds) for x in (v, int(round(b)))]
+        if self.distinct:
+            sk = report[2]
+            vals += [sk['src'].estimate(), sk['dst'].estimate(), sk['prefix'].estimate()]
+        return vals
+
+
+counter_table = CounterTable(ports, protocols)
+
+
+class SampleVariance(object):
+    """
+        Sums of squares of packets and bytes of the sampled flows for every
+        counter. With flows taken with probability 1/rate the variance of
+        counter scaled by rate is estimated as rate * (rate - 1) * sum of
+        squares (Horvitz-Thompson).
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.sq = table.new('d')
+
+    def count_flow(self, drop, r):
+        self.table.count_flow(self.sq, drop, r[:7] + (r[7] * r[7], r[8] * r[8]))
+
+    def count_bulk(self, drop, proto, srcport, dstport, packets, nbytes):
+        packets = packets.astype(numpy.float64)
+        nbytes = nbytes.astype(numpy.float64)
+        self.table.count_bulk(self.sq, drop, proto, srcport, dstport, packets * packets, nbytes * nbytes)
 
-            update(drop_proto_packets, r[2], r[7])
-            update(drop_proto_bytes, r[2], r[8])
+    def merge(self, other):
+        for (i, v) in enumerate(other.sq):
+            self.sq[i] += v
+        return self
 
-            update(drop_port_packets, r[4], r[7])
-            update(drop_port_bytes, r[4], r[8])
+    def bounds(self, rate):
+        """
+            Half-widths of the 95% confidence intervals of the counters
+            scaled by rate.
+        """
+        return [1.96 * math.sqrt(rate * (rate - 1) * v) for v in self.sq]
 
-            if r[4] != r[6]:
-                update(drop_port_packets, r[6], r[7])
-                update(drop_port_bytes, r[6], r[8])
-        else: # ROV accepts the flow
-            update(accept_proto_packets, r[2], r[7])
-            update(accept_proto_bytes, r[2], r[8])
 
-            update(accept_port_packets, r[4], r[7])
-            update(accept_port_bytes, r[4], r[8])
+def sample_chunks(chunks, rate):
+    """
+        Deterministic sample of about 1 of rate flows of chunks. A flow is
+        taken when the hash of its 5-tuple is divisible by rate, so every
+        run (and filter) sees the same flows.
+    """
+    for chunk in chunks:
+        if numpy:
+            cols = [numpy.asarray(chunk[c]).astype(numpy.uint64) for c in ('src', 'dst', 'srcport', 'dstport', 'protocol')]
+            h = hll.hash_array((cols[2] << numpy.uint64(24)) | (cols[3] << numpy.uint64(8)) | cols[4])
+            h = hll.hash_array(hll.hash_array(h ^ cols[1]) ^ cols[0])
+            idx = numpy.flatnonzero(h % numpy.uint64(rate) == 0)
+            yield dict((c, chunk[c][idx] if isinstance(chunk[c], numpy.ndarray) else [chunk[c][i] for i in idx.tolist()]) for c in record_columns)
+        else:
+            rows = [r for r in chunk_rows(chunk) if sample_hash(r) % rate == 0]
+            yield dict((c, [r[i] for r in rows]) for (i, c) in enumerate(record_columns))
+
 
-            if r[4] != r[6]:
-                update(accept_port_packets, r[6], r[7])
-                update(accept_port_bytes, r[6], r[8])
+def sample_hash(r):
+    """
+        Hash of the 5-tuple of record r, the same as in sample_chunks.
+    """
+    h = hll.hash_int((r[4] << 24) | (r[6] << 8) | r[2])
+    return hll.hash_int(hll.hash_int(h ^ r[5]) ^ r[3])
 
 
-    if ofh:
-        ofh.close()
+def process_records(records, fltr, srcfilename, outdir, batch=None, lookup=None, accepted=()):
+    """
+        Aggregate records produced by process_nfdump_output(..., intaddr=True).
+        See process_chunks.
+    """
+    return process_chunks(chunk_records(records), fltr, srcfilename, outdir, batch, lookup, chunk_records(accepted))
 
-    return (decode_nfdump_time(srcfilename), drop_proto_packets, drop_proto_bytes, drop_port_packets, drop_port_bytes, accept_proto_packets, accept_proto_bytes, accept_port_packets, accept_port_bytes)
 
-def decode_header():
-    return ["time", "router"]+["drop_packets_proto_%d" % p for p in protocols]+["drop_packets_proto_other"]+["drop_bytes_proto_%d" % p for p in protocols]+["drop_bytes_proto_other"]+["drop_packets_port_%d" % p for p in ports]+["drop_packets_port_other"]+["drop_bytes_port_%d" % p for p in ports]+["drop_bytes_port_other"]+["accept_packets_proto_%d" % p for p in protocols]+["accept_packets_proto_other"]+["accept_bytes_proto_%d" % p for p in protocols]+["accept_bytes_proto_other"]+["accept_packets_port_%d" % p for p in ports]+["accept_packets_port_other"]+["accept_bytes_port_%d" % p for p in ports]+["accept_bytes_port_other"]
+def process_chunks(chunks, fltr, srcfilename, outdir, batch=None, lookup=None, accepted=()):
+    """
+        Aggregate flows given as chunks of columns (see chunk_records).
+        fltr is iptree.IPLookupTree, batch is optional ipbatch.IPIntervalSet
+        built from the same filter. When batch is given whole chunks are
+        matched and summed with numpy and fltr is not used. Otherwise each
+        address is matched by lookup, fltr.lookupBestInt by default.
+        Chunks in accepted are known not to be dropped (e.g. the rest pass
+        of nfdump pushdown) and are added to the accept counters without
+        matching.
+    """
+    return process_chunks_multi(chunks, [SimFilter(None, fltr, batch, lookup)], srcfilename, outdir, accepted)[0]
+
+
+class FlowOutput(object):
+    """
+        Format of the dropped flows written to outdir/<router> (every
+        router has files of the same names): fmt is 'csv' (one
+        <nfcapd>[.<filter>].csv per file) or 'bin' (columnar, one
+        <nfcapd>[.<filter>].<column>.bin per column with little endian
+        values of binary_column_types, date as UNIX timestamp), compress
+        is None, 'gzip' or 'zstd' (needs the zstandard module) and columns
+        is the list of record_columns to keep.
+    """
+
+    def __init__(self, fmt='csv', compress=None, columns=record_columns):
+        self.fmt = fmt
+        self.compress = compress
+        self.columns = list(columns)
+
+    def filenames(self, outdir, srcfilename, name=None, part=None, router=None):
+        if router:
+            outdir = os.path.join(outdir, router)
+        base = os.path.join(outdir, '%s.%s' % (srcfilename, name) if name else srcfilename)
+        if self.fmt == 'bin':
+            fns = ['%s.%s.bin' % (base, c) for c in self.columns]
+        else:
+            fns = ['%s.csv' % base]
+        suffix = {None: '', 'gzip': '.gz', 'zstd': '.zst'}[self.compress]
+        if part is not None:
+            suffix += '.part%d' % part
+        return [fn + suffix for fn in fns]
+
+    def open(self, outdir, srcfilename, name=None, part=None, router=None):
+        """
+            Open DropWriter for flows of srcfilename dropped by filter name.
+            Parts of a file (see process_chunks_multi) are joined by join().
+        """
+        fns = self.filenames(outdir, srcfilename, name, part, router)
+        os.makedirs(os.path.dirname(fns[0]) or '.', exist_ok=True)
+        return DropWriter(self, fns, not part)
+
+    def join(self, outdir, srcfilename, name, parts, router=None):
+        """
+            Concatenate part files in order and remove them. Compressed
+            streams can be concatenated as well.
+        """
+        for (i, fn) in enumerate(self.filenames(outdir, srcfilename, name, None, router)):
+            with open(fn, 'wb') as ofh:
+                for part in range(parts):
+                    pfn = self.filenames(outdir, srcfilename, name, part, router)[i]
+                    with open(pfn, 'rb') as pfh:
+                        shutil.copyfileobj(pfh, ofh)
+                    os.remove(pfn)
+
+    def open_file(self, fn):
+        if self.compress == 'gzip':
+            # closes the file with the gzip stream, GzipFile(fileobj=...) does not
+            return gzip.open(fn, 'wb', compresslevel=6)
+        fh = open(fn, 'wb', buffering=1 << 20)
+        if self.compress == 'zstd':
+            return zstandard.ZstdCompressor().stream_writer(fh)
+        return fh
+
+
+# array.array types of the columns in FlowOutput 'bin' format
+binary_column_types = dict(zip(nfcapd.columns, nfcapd.column_types))
+
+
+class DropWriter(object):
+    """
+        Writer of dropped flows that collects them and writes them out in
+        blocks of flush_size flows.
+    """
+    flush_size = 65536
+
+    def __init__(self, output, filenames, header=True):
+        self.output = output
+        self.fhs = [output.open_file(fn) for fn in filenames]
+        self.cols = [record_columns.index(c) for c in output.columns]
+        self.count = 0
+        if output.fmt == 'bin':
+            self.buf = [array.array(binary_column_types[c]) for c in output.columns]
+        else:
+            self.buf = []
+            if header:
+                self.buf.append(output.columns)
+
+    def add_record(self, r):
+        """
+            Add record with int addresses.
+        """
+        if self.output.fmt == 'bin':
+            for (b, i) in zip(self.buf, self.cols):
+                b.append(record_timestamp(r[i]) if i == 0 else r[i])
+        else:
+            r = format_record(r)
+            self.buf.append([r[i] for i in self.cols])
+        self.count += 1
+        if self.count >= self.flush_size:
+            self.flush()
+
+    def add_chunk(self, chunk, idx):
+        """
+            Add flows of chunk (see chunk_records) at numpy indices idx.
+        """
+        if self.output.fmt == 'bin':
+            for (b, c) in zip(self.buf, self.output.columns):
+                col = chunk[c]
+                if c == 'date' and not isinstance(col, (array.array, numpy.ndarray)):
+                    b.extend(record_timestamp(col[i]) for i in idx)
+                else:
+                    b.frombytes(numpy.asarray(col)[idx].astype(b.typecode).tobytes())
+            self.count += len(idx)
+            if self.count >= self.flush_size:
+                self.flush()
+        else:
+            for i in idx:
+                self.add_record([chunk[c][i] for c in record_columns])
+
+    def flush(self):
+        if self.output.fmt == 'bin':
+            for (b, fh) in zip(self.buf, self.fhs):
+                if sys.byteorder != 'little':
+                    b.byteswap()
+                fh.write(b.tobytes())
+            self.buf = [array.array(b.typecode) for b in self.buf]
+        else:
+            out = io.StringIO()
+            csv.writer(out, quoting=csv.QUOTE_MINIMAL).writerows(self.buf)
+            self.fhs[0].write(out.getvalue().encode())
+            self.buf = []
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        for fh in self.fhs:
+            fh.close()
+
+
+flow_output = FlowOutput()
+
+
+def process_chunks_multi(chunks, filters, srcfilename, outdir, accepted=(), part=None, router=None):
+    """
+        Evaluate every flow against all filters (list of SimFilter) in one
+        pass over chunks. Returns list of reports in the order of filters.
+        The dropped flows are written under outdir/router (see
+        FlowOutput). With part the chunks are just a part of the file, the dropped
+        flows go to part files (see FlowOutput.join) and the reports are
+        to be merged by merge_report. When counter_table.sample is set the
+        chunks are the sample (see sample_chunks), the counters and top-k
+        summaries are scaled up and the reports carry SampleVariance.
+    """
+    time = decode_nfdump_time(srcfilename)
+    counters = [counter_table.new() for f in filters]
+    # per filter summaries beyond the counters
+    sketches = [{} for f in filters]
+    for (f, sk) in zip(filters, sketches):
+        if f.attrib and f.topk_size:
+            sk['topk'] = topk.SpaceSaving(f.topk_size)
+        if counter_table.distinct:
+            for k in ('src', 'dst', 'prefix'):
+                sk[k] = hll.HyperLogLog()
+        if counter_table.sample > 1:
+            sk['variance'] = SampleVariance(counter_table)
+    batch_filters = [(f, c, sk) for (f, c, sk) in zip(filters, counters, sketches) if f.batch]
+    flow_filters = [(f.lookup, c, f.attrib, sk, sk.get('variance')) for (f, c, sk) in zip(filters, counters, sketches) if not f.batch]
+
+    writers = {}
+    if outdir:
+        for f in filters:
+            writers[f] = flow_output.open(outdir, srcfilename, f.name, part, router)
+
+    for chunk in chunks:
+        if batch_filters:
+            proto = numpy.asarray(chunk['protocol'], dtype=numpy.int64)
+            srcport = numpy.asarray(chunk['srcport'], dtype=numpy.int64)
+            dstport = numpy.asarray(chunk['dstport'], dtype=numpy.int64)
+            packets = numpy.asarray(chunk['packets'], dtype=numpy.int64)
+            nbytes = numpy.asarray(chunk['bytes'], dtype=numpy.int64)
+            addrs = numpy.concatenate((numpy.asarray(chunk['src'], dtype=numpy.uint32), numpy.asarray(chunk['dst'], dtype=numpy.uint32)))
+            n = len(proto)
+
+            for (f, c, sk) in batch_filters:
+                hit = f.batch.contains(addrs)
+                drop = hit[:n] & ~hit[n:] # ROV is dropping the flow
+                if f in writers:
+                    writers[f].add_chunk(chunk, numpy.flatnonzero(drop))
+                counter_table.count_bulk(c, drop, proto, srcport, dstport, packets, nbytes)
+                if 'variance' in sk:
+                    sk['variance'].count_bulk(drop, proto, srcport, dstport, packets, nbytes)
+                if counter_table.distinct:
+                    sk['src'].add_array(addrs[:n][drop])
+                    sk['dst'].add_array(addrs[n:][drop])
+                if f.attrib:
+                    attribute_drops(f.attrib, sk, addrs[:n][drop], packets[drop], nbytes[drop], numpy.asarray(chunk['flows'], dtype=numpy.int64)[drop])
+
+        if flow_filters:
+            flow_writers = [writers.get(f) for f in filters if not f.batch]
+            for r in chunk_rows(chunk):
+                for ((lookup, c, attrib, sk, var), w) in zip(flow_filters, flow_writers):
+                    drop = bool(lookup(r[3]) and not lookup(r[5])) # ROV is dropping the flow
+                    if drop:
+                        if w:
+                            w.add_record(r)
+                        if sk:
+                            add_drop(attrib, sk, r)
+                    counter_table.count_flow(c, drop, r)
+                    if var:
+                        var.count_flow(drop, r)
+
+    for chunk in accepted:
+        for r in chunk_rows(chunk):
+            for (c, sk) in zip(counters, sketches):
+                counter_table.count_flow(c, False, r)
+                if 'variance' in sk:
+                    sk['variance'].count_flow(False, r)
+
+    for w in writers.values():
+        w.close()
+
+    if counter_table.sample > 1:
+        for (c, sk) in zip(counters, sketches):
+            for i in range(len(c)):
+                c[i] *= counter_table.sample
+            if 'topk' in sk:
+                sk['topk'].scale(counter_table.sample)
+
+    return [(time, c, sk) for (c, sk) in zip(counters, sketches)]
+
+
+def add_drop(attrib, sk, r):
+    """
+        Add dropped flow r to the sketches sk of its filter.
+    """
+    if 'src' in sk:
+        sk['src'].add_int(r[3])
+        sk['dst'].add_int(r[5])
+    if attrib:
+        pfx = attrib.lookupBestInt(r[3])
+        if 'topk' in sk:
+            sk['topk'].add(pfx, r[8], r[7], r[9])
+        if 'prefix' in sk:
+            sk['prefix'].add_str(pfx)
+
+
+def attribute_drops(attrib, sk, src, packets, nbytes, flows):
+    """
+        Add dropped flows given as numpy columns to the top-k summary
+        and the distinct prefix sketch in sk under the filter prefix that
+        covers the source address.
+    """
+    (addrs, inv) = numpy.unique(src, return_inverse=True)
+    sums = numpy.zeros((3, len(addrs)), dtype=numpy.int64)
+    numpy.add.at(sums[0], inv, nbytes)
+    numpy.add.at(sums[1], inv, packets)
+    numpy.add.at(sums[2], inv, flows)
+
+    prefixes = {}
+    for (a, b, p, f) in zip(addrs.tolist(), *sums.tolist()):
+        t = prefixes.setdefault(attrib.lookupBestInt(a), [0, 0, 0])
+        t[0] += b
+        t[1] += p
+        t[2] += f
+    if 'topk' in sk:
+        for (pfx, (b, p, f)) in prefixes.items():
+            sk['topk'].add(pfx, b, p, f)
+    if 'prefix' in sk:
+        for pfx in prefixes:
+            sk['prefix'].add_str(pfx)
+
+
+def merge_report(report, other):
+    """
+        Add counters and summaries of other report of the same file
+        (another part of it) to report.
+    """
+    (time, c, sk) = report
+    for (i, v) in enumerate(other[1]):
+        c[i] += v
+    for (k, v) in other[2].items():
+        sk[k].merge(v)
+    return report
+
 
+def decode_header(named=False):
+    return ["time", "router"]+(["filter"] if named else [])+counter_table.report_header()
 
 
-def decode_rep(report, filename):
-    (time, drop_proto_packets, drop_proto_bytes, drop_port_packets, drop_port_bytes, accept_proto_packets, accept_proto_bytes, accept_port_packets, accept_port_bytes) = report
-    return [time, decode_hostname(filename)]+[drop_proto_packets[k] for k in (protocols + [None])]+[drop_proto_bytes[k] for k in (protocols + [None])]+[drop_port_packets[k] for k in (ports + [None])]+[drop_port_bytes[k] for k in (ports + [None])]+[accept_proto_packets[k] for k in (protocols + [None])]+[accept_proto_bytes[k] for k in (protocols + [None])]+[accept_port_packets[k] for k in (ports + [None])]+[accept_port_bytes[k] for k in (ports + [None])]
+def decode_rep(report, filename, name=None):
+    return [report[0], decode_hostname(filename)]+([name] if name else [])+counter_table.values(report)
 
 
-def run_nfdump(nfd_fn):
-    dbg('Running nfdump -N -r %s' % (nfd_fn))
-    p = subprocess.Popen(['nfdump', '-N', '-r', nfd_fn], stdout=subprocess.PIPE)
-    res = process_nfdump_output(p.stdout)
+def run_nfdump(nfd_fn, fltrfile=None, aggregate=None, fast=False, stats=None):
+    """
+        Start nfdump on nfd_fn, optionally with filter file (nfdump -f)
+        and aggregation (nfdump -A). With fast the output is requested in
+        nfdump_csv_format and parsed by process_nfdump_csv into stats.
+    """
+    args = ['nfdump', '-N', '-r', nfd_fn]
+    if fast:
+        args += ['-q', '-o', nfdump_csv_format]
+    if aggregate:
+        args += ['-A', aggregate]
+    if fltrfile:
+        args += ['-f', fltrfile]
+    dbg('Running %s' % ' '.join(args))
+    p = subprocess.Popen(args, stdout=subprocess.PIPE)
+    if fast:
+        res = process_nfdump_csv(p.stdout, stats)
+    else:
+        res = process_nfdump_output(p.stdout, intaddr=True)
     return (res, p)
 
 
-def worker(params):
+def write_nfdump_filters(prefixes):
+    """
+        Write the filter prefixes as nfdump filter files. The candidate
+        filter selects flows with source in some prefix, i.e. the only ones
+        that can be dropped. The rest filter is its complement.
+        Returns (candidate filter file name, rest filter file name).
+    """
+    if prefixes:
+        expr = ' or\n'.join('src net %s' % str(ipaddress.IPv4Network(p)) for p in prefixes)
+    else:
+        expr = 'not any'
+
+    fns = []
+    for text in (expr, 'not (\n%s\n)' % expr):
+        (fd, fn) = tempfile.mkstemp(prefix='nfsim_', suffix='.filter')
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(text + '\n')
+        fns.append(fn)
+    return tuple(fns)
+
+
+def nfdump_flows(nfd_fn, fltrfile=None, aggregate=None, fast=False, stats=None):
+    """
+        Flow source running nfdump (see run_nfdump), yields chunks of columns.
+    """
+    (res, p) = run_nfdump(nfd_fn, fltrfile, aggregate, fast, stats)
+    yield from chunk_records(res)
+    dbg('nfdump exited with code %d' % p.wait())
+
+
+def flowcache_path(cachedir, nfd_fn):
+    return os.path.join(cachedir, decode_hostname(nfd_fn), os.path.basename(nfd_fn))
+
+
+def read_flows(nfd_fn, native=False, fast=False, pushdown=None, stats=None, cachedir=None):
+    """
+        Open flow source for nfd_fn. With cachedir the flows are replayed
+        from the columnar flow cache (flowcache module) when it is valid
+        and the cache is written on the way otherwise. The native reader
+        (nfcapd module) is used when requested and the file is supported
+        by it, nfdump is the fallback. pushdown is the pair of filter files
+        from write_nfdump_filters, it is not used when the cache is written
+        as it needs every flow.
+        Returns (chunks, accepted chunks) for process_chunks.
+    """
+    if cachedir:
+        path = flowcache_path(cachedir, nfd_fn)
+        chunks = flowcache.load(path, nfd_fn, chunk_size)
+        if chunks is not None:
+            dbg('Replaying %s from flow cache %s' % (nfd_fn, path))
+            return (chunks, ())
+        (chunks, accepted) = read_flows(nfd_fn, native, fast, None, stats)
+        return (flowcache.store(path, nfd_fn, chunks, record_timestamp), accepted)
+
+    if native and nfcapd.is_supported(nfd_fn):
+        dbg('Reading %s natively' % nfd_fn)
+        return (nfcapd.read_blocks(nfd_fn, stats), ())
+    if pushdown:
+        # flows with source outside of the filter are accepted,
+        # let nfdump sum them up
+        (candfn, restfn) = pushdown
+        return (nfdump_flows(nfd_fn, candfn, fast=fast, stats=stats), nfdump_flows(nfd_fn, restfn, 'proto,srcport,dstport', fast, stats))
+    return (nfdump_flows(nfd_fn, fast=fast, stats=stats), ())
+
+
+def init_worker(filters, outdir, cache_size, pushdown=None, fast_parser=False, native=False, flowcachedir=None, table=None, output=None, topk_size=0):
+    """
+        Pool initializer. The filters, list of (name, IPLookupTree, IPIntervalSet,
+        attribution IPLookupTree), are handed over once per worker process
+        (inherited on fork) so that the tasks carry just the file names.
+        With cache_size every filter that is matched flow by flow gets LRU
+        cache of verdicts. table is the CounterTable and output the
+        FlowOutput of the main process, topk_size is the size of the drop
+        attribution summaries.
+    """
+    global worker_filters, worker_outdir, worker_pushdown, worker_fast_parser, worker_native, worker_flowcache, counter_table, flow_output
+    worker_filters = []
+    for (name, fltr, batch, attrib) in filters:
+        lookup = None
+        if cache_size and not batch:
+            lookup = make_verdict_cache(fltr, cache_size)
+        worker_filters.append(SimFilter(name, fltr, batch, lookup, attrib, topk_size))
+    worker_outdir = outdir
+    worker_pushdown = pushdown
+    worker_fast_parser = fast_parser
+    worker_native = native
+    worker_flowcache = flowcachedir
+    if table:
+        counter_table = table
+    if output:
+        flow_output = output
+
+
+def worker(task):
+    """
+        Process task (file name, part, offset, blocks) from plan_tasks.
+        Returns (file name, part, list of reports in the order of filters).
+    """
+    (fn, part, offset, blocks) = task
     try:
-        (fn, fltr, outdir) = params
-        dbg("worker started with %s"%fn)
-        (res, proc) = run_nfdump(fn)
-        rep = process_records(res, fltr, os.path.split(fn)[-1], outdir)
-        nfdump_exit_code = proc.wait()
-        dbg('nfdump exited with code %d'%nfdump_exit_code)
-
-        write_status(decode_nfdump_time(fn))
-
-        ret = decode_rep(rep, fn)
-        dbg("return from worker: %s"%ret)
-        return ret
+        dbg("worker started with %s%s"%(fn, '' if part is None else ' part %d' % part))
+        caches = [f for f in worker_filters if hasattr(f.lookup, 'cache_info')]
+        cache_before = [f.lookup.cache_info() for f in caches]
+
+        stats = {}
+        if part is None:
+            (chunks, accepted) = read_flows(fn, worker_native, worker_fast_parser, worker_pushdown, stats, worker_flowcache)
+        else:
+            (chunks, accepted) = (nfcapd.read_blocks(fn, stats, offset, blocks), ())
+        if counter_table.sample > 1:
+            chunks = sample_chunks(chunks, counter_table.sample)
+        reps = process_chunks_multi(chunks, worker_filters, os.path.split(fn)[-1], worker_outdir, accepted, part, decode_hostname(fn))
+        if stats.get('malformed') or stats.get('ipv6'):
+            print("Skipped %d malformed and %d IPv6 flows from %s" % (stats.get('malformed', 0), stats.get('ipv6', 0), fn))
+        if stats.get('unknown_protocol'):
+            print("Counted %d flows with unknown protocol name as other protocols from %s" % (stats['unknown_protocol'], fn))
+
+        for (f, cb) in zip(caches, cache_before):
+            ci = f.lookup.cache_info()
+            dbg('verdict cache %sfor %s: hits=%d misses=%d size=%d/%d' % ('%s ' % f.name if f.name else '', fn, ci.hits - cb.hits, ci.misses - cb.misses, ci.currsize, ci.maxsize))
+
+        dbg("return from worker: %s"%str(reps))
+        return (fn, part, reps)
     except Exception as e:
         print("Worker failed: %s"%e)
         raise
 
 
-def run_sim(rootdir, fltrfn, outdir, reportfn):
-    fltr = read_filter(fltrfn)
-    files = filter_newer(sort_nfdump_files(find_files(rootdir)), read_status())
+def load_filters(fltrfns, cache_size=0, compact=True, attribution=False):
+    """
+        Load filters for init_worker. fltrfns is list of (name, file name).
+        With compact the prefixes are collapsed by compact_prefixes before
+        the matchers are built, with attribution a tree of the original
+        prefixes is built for drop attribution. Returns (list of (name,
+        IPLookupTree, IPIntervalSet, attribution IPLookupTree), union of
+        all prefixes).
+    """
+    filters = []
+    allprefixes = set()
+    for (name, fn) in fltrfns:
+        prefixes = read_filter_prefixes(fn)
+        attrib = build_attribution(prefixes) if attribution else None
+        if compact:
+            compacted = compact_prefixes(prefixes)
+            print("Filter %s: %d prefixes, %d after compaction" % (fn, len(prefixes), len(compacted)))
+            prefixes = compacted
+        allprefixes.update(prefixes)
+        if ipbatch and not cache_size:
+            batch = ipbatch.IPIntervalSet(prefixes)
+            dbg("batch matcher %s with %d intervals" % (fn, len(batch)))
+            filters.append((name, None, batch, attrib))
+        else:
+            filters.append((name, build_filter(prefixes), None, attrib))
+    if compact:
+        allprefixes = compact_prefixes(allprefixes)
+    return (filters, sorted(allprefixes))
+
+
+def filters_signature(fltrfns):
+    """
+        Cheap change detection for the filter files.
+    """
+    sig = []
+    for (name, fn) in fltrfns:
+        st = os.stat(fn)
+        sig.append((fn, st.st_mtime_ns, st.st_size))
+    return sig
+
+
+def start_pool(fltrfns, outdir, cache_size=0, pushdown=False, fast_parser=False, native=False, flowcachedir=None, processes=None, topk_size=0):
+    """
+        Load filters and start pool of workers with them.
+        Returns (pool, nfdump filter files or None).
+    """
+    (filters, allprefixes) = load_filters(fltrfns, cache_size, attribution=bool(topk_size) or counter_table.distinct)
+    nfdump_filters = None
+    if pushdown:
+        # candidate flows of any of the filters
+        nfdump_filters = write_nfdump_filters(allprefixes)
+    p = multiprocessing.Pool(processes=processes, initializer=init_worker, initargs=(filters, outdir, cache_size, nfdump_filters, fast_parser, native, flowcachedir, counter_table, flow_output, topk_size))
+    return (p, nfdump_filters)
+
+
+def stop_pool(p, nfdump_filters):
+    p.close()
+    p.join()
+    if nfdump_filters:
+        for fn in nfdump_filters:
+            os.remove(fn)
+
+
+def pending_files(rootdir, journal):
+    """
+        Yield files under rootdir not finished yet according to the
+        journal in time order.
+    """
+    return (fn for fn in find_files(rootdir, journal.oldest()) if not journal.is_done(fn))
+
+
+def file_size(fn):
+    try:
+        return os.stat(fn).st_size
+    except OSError:
+        return 0
+
+
+def plan_tasks(files, split_size=0):
+    """
+        Make worker tasks (file name, part, offset, blocks, size) of files.
+        Files bigger than split_size that the native reader supports are
+        split to parts of about split_size bytes that are processed in
+        parallel, the rest is processed as a whole (part None).
+    """
+    for fn in files:
+        size = file_size(fn)
+        if split_size and size > split_size and nfcapd.is_supported(fn):
+            ranges = nfcapd.block_ranges(fn, split_size)
+            if len(ranges) > 1:
+                dbg("splitting %s to %d parts" % (fn, len(ranges)))
+                for (part, (offset, blocks)) in enumerate(ranges):
+                    yield (fn, part, offset, blocks, size // len(ranges))
+                continue
+        yield (fn, None, None, None, size)
+
+
+def write_sidecars(sidecardir, fn, names, reps):
+    """
+        Write drop attribution summaries of file fn to sidecars
+        <sidecardir>/<router>/<nfcapd>[.<filter>].topk.json and the
+        distinct count sketches to <nfcapd>[.<filter>].hll.json.
+    """
+    router = decode_hostname(fn)
+    srcfilename = os.path.split(fn)[-1]
+    os.makedirs(os.path.join(sidecardir, router), exist_ok=True)
+    for (rep, name) in zip(reps, names):
+        base = os.path.join(sidecardir, router, '%s.%s' % (srcfilename, name) if name else srcfilename)
+        meta = {'file': srcfilename, 'router': router, 'time': str(rep[0]), 'filter': name}
+        sk = rep[2]
+        if 'topk' in sk:
+            topk.write_sidecar(base + '.topk.json', sk['topk'], meta)
+        if 'src' in sk:
+            hll.write_sidecar(base + '.hll.json', dict((k, sk[k]) for k in hll.sidecar_keys), meta)
+
+
+def write_report(p, files, reportfn, names, journal, split_size=0, outdir=None, sidecardir=None, store=None):
+    """
+        Process files in the pool and append the rows to the report in
+        time order as the workers finish, then record the files in the
+        journal. files have to be in time order, names are the filter
+        names. At most schedule_window files are handed to the pool ahead
+        of the oldest unwritten one, which bounds the results held back,
+        within a batch of new files the biggest tasks are handed out first
+        (one at a time) so that no worker is left with a run of huge files
+        at the end.
+        See plan_tasks for split_size. The drop attribution summaries (of
+        all parts of a file) and distinct count sketches go to sidecardir.
+        The results are added to the rollup.RollupStore store before the
+        files are recorded in the journal.
+    """
     write_header = True
     try:
         if os.stat(reportfn).st_size > 0:
@@ -229,59 +1445,263 @@ def run_sim(rootdir, fltrfn, outdir, reportfn):
     except:
         pass
 
-    p = multiprocessing.Pool(processes=4)
     with open(reportfn, 'a') as reportfh:
         reportcsv = csv.writer(reportfh, quoting=csv.QUOTE_MINIMAL)
         if write_header:
-            reportcsv.writerow(decode_header())
+            reportcsv.writerow(decode_header(any(names)))
+
+        results = queue.Queue()
+        files = iter(files)
+        # files handed to the pool and not written yet in time order,
+        # file name -> [tasks missing, merged reports, number of tasks]
+        inflight = collections.OrderedDict()
+        # reports of files finished ahead of some older file
+        ready = {}
+
+        def admit():
+            batch = list(itertools.islice(files, schedule_window - len(inflight)))
+            for fn in batch:
+                journal.start(fn)
+                inflight[fn] = [0, None, 0]
+            tasks = sorted(plan_tasks(batch, split_size), key=lambda t: t[4], reverse=True)
+            for t in tasks:
+                inflight[t[0]][0] += 1
+                inflight[t[0]][2] += 1
+            for t in tasks:
+                p.apply_async(worker, (t[:4],), callback=results.put, error_callback=lambda e, fn=t[0]: results.put(FileError(fn, e)))
+
+        admit()
+        while inflight:
+            res = results.get()
+            if isinstance(res, BaseException):
+                raise res
+            (fn, part, reps) = res
+            pr = inflight[fn]
+            pr[0] -= 1
+            pr[1] = reps if pr[1] is None else [merge_report(a, b) for (a, b) in zip(pr[1], reps)]
+            if pr[0]:
+                continue
+            reps = pr[1]
+            if part is not None and outdir:
+                for name in names:
+                    flow_output.join(outdir, os.path.split(fn)[-1], name, pr[2], decode_hostname(fn))
+            if sidecardir:
+                write_sidecars(sidecardir, fn, names, reps)
+            ready[fn] = ([decode_rep(rep, fn, name) for (rep, name) in zip(reps, names)], reps)
+
+            while inflight and next(iter(inflight)) in ready:
+                fn = inflight.popitem(last=False)[0]
+                (res, reps) = ready.pop(fn)
+                dbg("writing result from workers: %s"%str(res))
+                reportcsv.writerows(res)
+                # rows first, a crash in between repeats the file rather than losing it
+                reportfh.flush()
+                os.fsync(reportfh.fileno())
+                if store:
+                    store.add(decode_hostname(fn), os.path.split(fn)[-1], [(name,)+tuple(rep) for (rep, name) in zip(reps, names)])
+                journal.finish(fn)
+                print("Finished %s" % fn)
+            admit()
+
+
+def filter_list(fltrfn):
+    if isinstance(fltrfn, str):
+        return [(None, fltrfn)]
+    else:
+        return list(fltrfn)
 
-        for res in p.map(worker, list(zip(files, [fltr]*len(files), [outdir]*len(files)))):
-        #for param in list(zip(files, [fltr]*len(files), [outdir]*len(files))):
-        #    res = worker(param)
 
-            dbg("writing result from map(workers): %s"%str(res))
-            reportcsv.writerow(res)
+def run_sim(rootdir, fltrfn, outdir, reportfn, cache_size=0, pushdown=False, fast_parser=False, native=False, flowcachedir=None, processes=None, split_size=0, topk_size=0, sidecardir=None, rollupfn=None):
+    """
+        Run the simulation. fltrfn is the prefix list file name or list of
+        (name, file name) to evaluate several filters in one pass, the
+        report then has one row per file and filter. With the native
+        reader files bigger than split_size bytes are processed in parts in
+        parallel (not when the flow cache is used). With rollupfn the
+        results are also added to the hourly and daily rollups in that
+        SQLite file, see rollup.py.
+    """
+    fltrfns = filter_list(fltrfn)
+    names = [name for (name, fn) in fltrfns]
+    if not native or flowcachedir:
+        split_size = 0
+
+    journal = Journal()
+    store = rollup.RollupStore(rollupfn, counter_table.header()) if rollupfn else None
+    (p, nfdump_filters) = start_pool(fltrfns, outdir, cache_size, pushdown, fast_parser, native, flowcachedir, processes, topk_size)
+    try:
+        write_report(p, pending_files(rootdir, journal), reportfn, names, journal, split_size, outdir, sidecardir, store)
+    except:
+        p.terminate()
+        raise
+    finally:
+        stop_pool(p, nfdump_filters)
+        if store:
+            store.close()
 
-    print("Finished files:")
-    for fn in files:
-        print(fn)
 
+def run_daemon(rootdir, fltrfn, outdir, reportfn, interval, cache_size=0, pushdown=False, fast_parser=False, native=False, flowcachedir=None, processes=None, split_size=0, topk_size=0, sidecardir=None, rollupfn=None):
+    """
+        Watch mode. Keep the pool with loaded filters running and process
+        new nfcapd files every interval seconds as NFSen rotates them in.
+        The filters are reloaded (and the pool restarted) only when some of
+        the filter files changes. After a failure the pool is restarted and
+        the unfinished files are retried, a file that fails max_attempts
+        times is given up. See run_sim for split_size and rollupfn.
+    """
+    fltrfns = filter_list(fltrfn)
+    names = [name for (name, fn) in fltrfns]
+    if not native or flowcachedir:
+        split_size = 0
+
+    journal = Journal()
+    store = rollup.RollupStore(rollupfn, counter_table.header()) if rollupfn else None
+    sig = filters_signature(fltrfns)
+    # file name -> failed attempts
+    attempts = {}
+    (p, nfdump_filters) = start_pool(fltrfns, outdir, cache_size, pushdown, fast_parser, native, flowcachedir, processes, topk_size)
+    try:
+        while True:
+            newsig = filters_signature(fltrfns)
+            if newsig != sig:
+                print("Filter changed, reloading")
+                stop_pool(p, nfdump_filters)
+                (p, nfdump_filters) = start_pool(fltrfns, outdir, cache_size, pushdown, fast_parser, native, flowcachedir, processes, topk_size)
+                sig = newsig
+
+            files = pending_files(rootdir, journal)
+            first = next(files, None)
+            if first:
+                try:
+                    write_report(p, itertools.chain([first], files), reportfn, names, journal, split_size, outdir, sidecardir, store)
+                except Exception as e:
+                    # keep running, unfinished files are retried in the next round
+                    print("Processing failed: %s" % str(e))
+                    journal.pending.clear()
+                    if isinstance(e, FileError):
+                        attempts[e.filename] = attempts.get(e.filename, 0) + 1
+                        if attempts[e.filename] >= max_attempts:
+                            print("Giving up %s after %d attempts" % (e.filename, attempts.pop(e.filename)))
+                            journal.fail(e.filename)
+                    # tasks of the failed round may still be queued or running
+                    p.terminate()
+                    stop_pool(p, nfdump_filters)
+                    (p, nfdump_filters) = start_pool(fltrfns, outdir, cache_size, pushdown, fast_parser, native, flowcachedir, processes, topk_size)
+
+            time.sleep(interval)
+    finally:
+        p.terminate()
+        p.join()
+        if nfdump_filters:
+            for fn in nfdump_filters:
+                os.remove(fn)
+        if store:
+            store.close()
 
 
 def check_lock():
-    if not os.path.isfile(lock_file):
-        with open(lock_file, 'w') as lf:
+    """
+        Take the lock file. A lock left behind by a process that is not
+        running any more is taken over, as well as a lock without a valid
+        pid older than lock_grace seconds (the owner died before writing
+        its pid).
+    """
+    for attempt in range(2):
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(lock_file, 'r') as lf:
+                    pid = int(lf.read().strip())
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                print("Removing stale lock of pid %d" % pid)
+                os.remove(lock_file)
+                continue
+            except ValueError:
+                try:
+                    if time.time() - os.path.getmtime(lock_file) > lock_grace:
+                        print("Removing stale lock without pid")
+                        os.remove(lock_file)
+                        continue
+                except FileNotFoundError:
+                    continue
+            except (PermissionError, OSError):
+                pass
+            return False
+
+        with os.fdopen(fd, 'w') as lf:
             lf.write(str(os.getpid()))
         return True
-    else:
-        return False
+    return False
 
 
 def release_lock():
     os.remove(lock_file)
 
 
+def sigterm_handler(signum, frame):
+    sys.exit(0)
+
+
 def main():
     def usage():
         print("""SmartValidator NetFlow simulator
     %s <-d <dir>> [-hsre]
         -d | --dir <nfdump data directory>
-        -f | --filter <IP prefix list>
+        -f | --filter <[name=]IP prefix list> -- repeat to evaluate several named filters in one pass
         -h | --help
         -s | --saved -- filters traffic for salvaged invalid ROAs
         -r | --rpki -- filters traffic dropped by "raw" RPKI
         -e | --resolved -- filters traffic dropped in Smart mode
-        -o | --outdir <CSV out directory>
+        -o | --outdir <CSV out directory> -- dropped flows of each router go to <outdir>/<router>
         -p | --reportfile <CSV report file>
-""" % sys.argv[0])
+        -c | --cache-size <n> -- match flow by flow with LRU cache of n address verdicts per worker
+        -P | --pushdown -- let nfdump select candidate drop flows and sum up the rest
+        -F | --fast-parser -- read nfdump output in fixed CSV format
+        -n | --native -- read uncompressed nfcapd files without nfdump
+        -k | --flowcache <dir> -- keep parsed flows in dir (e.g. next to the report) and replay them in later runs
+        -w | --watch <seconds> -- keep running and look for new files every <seconds>
+        -j | --jobs <n> -- number of worker processes (default: number of CPUs)
+        -S | --split-size <MiB> -- with -n process files bigger than <MiB> in parts in parallel (not with -k)
+        -T | --ports <port,...> -- ports counted separately in the report (default: %s)
+        -R | --protocols <protocol number,...> -- protocols counted separately in the report (default: %s)
+        -b | --binary -- write dropped flows to outdir as binary columns instead of CSV
+        -z | --compress <gzip|zstd> -- compress dropped flows in outdir
+        -C | --columns <column,...> -- columns of dropped flows to keep (default: all)
+        -K | --topk <k> -- attribute dropped traffic to the top <k> filter prefixes, see topk.py
+        -U | --distinct -- estimate distinct dropped sources, destinations and filter prefixes, see hll.py
+        -a | --sidecar-dir <dir> -- directory of the per-file top-k and distinct count sidecars (default: outdir)
+        -m | --sample <n> -- quick preview processing 1 of n flows (by hash of the 5-tuple), the counters are scaled by n
+                             and followed by 95%% confidence bounds, distinct estimates are of the sampled flows
+        -Q | --rollup <SQLite file> -- keep hourly and daily rollups of the report, see rollup.py
+""" % (sys.argv[0], ','.join(str(p) for p in ports), ','.join(str(p) for p in protocols)))
 
     rootdir = None
-    fltrfn = None
+    fltrfns = []
     outdir = None
     reportfn = None
+    cache_size = 0
+    pushdown = False
+    fast_parser = False
+    native = False
+    flowcachedir = None
+    watch = 0
+    processes = None
+    split_size = 0
+    tracked_ports = ports
+    tracked_protocols = protocols
+    output_format = 'csv'
+    output_compress = None
+    output_columns = record_columns
+    topk_size = 0
+    sidecardir = None
+    distinct = False
+    rollupfn = None
+    sample = 1
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hd:sreo:f:p:", ["help", "dir=", "outdir=", "filter=", "reportfile="])
+        opts, args = getopt.getopt(sys.argv[1:], "hd:sreo:f:p:c:PFnk:w:j:S:T:R:bz:C:K:a:UQ:m:", ["help", "dir=", "outdir=", "filter=", "reportfile=", "cache-size=", "pushdown", "fast-parser", "native", "flowcache=", "watch=", "jobs=", "split-size=", "ports=", "protocols=", "binary", "compress=", "columns=", "topk=", "sidecar-dir=", "topk-dir=", "distinct", "rollup=", "sample="])
     except getopt.GetoptError as err:
         print(str(err))
         usage()
@@ -295,19 +1715,89 @@ def main():
         elif o in ("-o", "--outdir"):
             outdir = a
         elif o in ("-f", "--filter" ):
-            fltrfn = a
+            (name, sep, fn) = a.partition('=')
+            if sep and not os.path.sep in name:
+                fltrfns.append((name, fn))
+            else:
+                fltrfns.append((None, a))
         elif o in ("-p", "--reportfile"):
             reportfn = a
+        elif o in ("-c", "--cache-size"):
+            cache_size = int(a)
+        elif o in ("-P", "--pushdown"):
+            pushdown = True
+        elif o in ("-F", "--fast-parser"):
+            fast_parser = True
+        elif o in ("-n", "--native"):
+            native = True
+        elif o in ("-k", "--flowcache"):
+            flowcachedir = a
+        elif o in ("-w", "--watch"):
+            watch = float(a)
+        elif o in ("-j", "--jobs"):
+            processes = int(a)
+        elif o in ("-S", "--split-size"):
+            split_size = int(float(a) * 1024 * 1024)
+        elif o in ("-T", "--ports"):
+            tracked_ports = [int(x) for x in a.split(',') if x]
+        elif o in ("-R", "--protocols"):
+            tracked_protocols = [int(x) for x in a.split(',') if x]
+        elif o in ("-b", "--binary"):
+            output_format = 'bin'
+        elif o in ("-z", "--compress"):
+            output_compress = a
+        elif o in ("-C", "--columns"):
+            output_columns = [x for x in a.split(',') if x]
+        elif o in ("-K", "--topk"):
+            topk_size = int(a)
+        elif o in ("-a", "--sidecar-dir", "--topk-dir"):
+            sidecardir = a
+        elif o in ("-U", "--distinct"):
+            distinct = True
+        elif o in ("-Q", "--rollup"):
+            rollupfn = a
+        elif o in ("-m", "--sample"):
+            sample = int(a)
         else:
             assert False, "unhandled option"
 
     assert rootdir, "missing root directory"
-    assert fltrfn, "missing filter option"
+    assert fltrfns, "missing filter option"
+    if len(fltrfns) > 1:
+        assert all(name for (name, fn) in fltrfns), "multiple filters have to be named"
+        assert len(set(name for (name, fn) in fltrfns)) == len(fltrfns), "duplicate filter names"
     assert reportfn, "missing report file name"
+    assert flowcache or not flowcachedir, "flow cache needs numpy"
+    assert all(0 <= x < 65536 for x in tracked_ports) and len(set(tracked_ports)) == len(tracked_ports), "invalid or duplicate ports"
+    assert all(0 <= x < 256 for x in tracked_protocols) and len(set(tracked_protocols)) == len(tracked_protocols), "invalid or duplicate protocols"
+
+    assert output_compress in (None, 'gzip', 'zstd'), "unknown compression %s" % output_compress
+    assert output_compress != 'zstd' or zstandard, "zstd compression needs the zstandard module"
+    assert output_columns and all(c in record_columns for c in output_columns), "columns have to be some of %s" % ','.join(record_columns)
+    assert sample >= 1, "sample has to be a positive number"
+    assert sample == 1 or not pushdown, "sampling can not be combined with --pushdown"
+
+    if (topk_size or distinct) and not sidecardir:
+        sidecardir = outdir
+    assert sidecardir or not topk_size, "top-k needs --sidecar-dir or --outdir"
+
+    global counter_table, flow_output
+    counter_table = CounterTable(tracked_ports, tracked_protocols, distinct, sample)
+    flow_output = FlowOutput(output_format, output_compress, output_columns)
 
     if check_lock():
-        run_sim(rootdir, fltrfn, outdir, reportfn)
-        release_lock()
+        try:
+            if watch:
+                signal.signal(signal.SIGTERM, sigterm_handler)
+                run_daemon(rootdir, fltrfns, outdir, reportfn, watch, cache_size, pushdown, fast_parser, native, flowcachedir, processes, split_size, topk_size, sidecardir, rollupfn)
+            else:
+                run_sim(rootdir, fltrfns, outdir, reportfn, cache_size, pushdown, fast_parser, native, flowcachedir, processes, split_size, topk_size, sidecardir, rollupfn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            release_lock()
+    else:
+        print("Another instance is running (%s)" % lock_file)
 
 
 if __name__ == '__main__':
@@ -3,13 +3,7 @@
 # SmartValidator - simulator component
 # by Tomas Hlavacek (tmshlvck@gmail.com)
 
-import password
-
 debug=0
-db_host=password.db_host
-db_name=password.db_name
-db_user=password.db_user
-db_passwd=password.db_passwd
 
 import sys
 import os
@@ -17,28 +11,56 @@ import datetime
 import tempfile
 import subprocess
 import getopt
-import psycopg2
 import csv
+import ipaddress
+
+import dbexport
 
 def dbg(text):
     if debug:
         print(text)
 
 
-def dbconn():
-    return 'host=%s dbname=%s user=%s password=%s' % (db_host, db_name, db_user, db_passwd)
-
-
-def dbselect(select):
-    conn = psycopg2.connect(dbconn())
-    cur = conn.cursor()
-    cur.execute(select)
-    for r in cur:
-        yield r
-
-    # conn.commit()
-    cur.close()
-    conn.close() 
+def read_prefixes(fn):
+    """
+        Read prefix list written by dbexport.write_prefixes, empty set
+        when there is none yet.
+    """
+    try:
+        with open(fn, "r") as fh:
+            return set(l.strip() for l in fh if l.strip())
+    except FileNotFoundError:
+        return set()
+
+
+def prefix_key(p):
+    net = ipaddress.ip_network(p)
+    return (net.version, net)
+
+
+def write_delta(rows, statefn, outfn):
+    """
+        Write only changes of the prefix list since the previous export kept
+        in statefn to outfn: "+<prefix>" lines for added and "-<prefix>" lines
+        for withdrawn prefixes. statefn is replaced by the current list
+        afterwards, when that does not happen the next delta repeats the
+        changes, which is harmless. Returns (added, withdrawn) counts.
+    """
+    old = read_prefixes(statefn)
+    new = set(dbexport.format_prefix(r).strip() for r in rows)
+    added = sorted(new - old, key=prefix_key)
+    withdrawn = sorted(old - new, key=prefix_key)
+
+    tmpfn = '%s.tmp%d' % (outfn, os.getpid())
+    with open(tmpfn, "w") as outfh:
+        for p in added:
+            outfh.write("+%s\n" % p)
+        for p in withdrawn:
+            outfh.write("-%s\n" % p)
+    os.replace(tmpfn, outfn)
+
+    dbexport.write_prefixes(((p,) for p in sorted(new, key=prefix_key)), statefn)
+    return (len(added), len(withdrawn))
 
 
 def get_fltr_saved_conflicts():
@@ -47,11 +69,13 @@ def get_fltr_saved_conflicts():
     return debug_fltr
 
 
-def get_fltr_raw_rpki():
-    # conflicts found by conflict seeker (RIPE validator result)
-    #for r in dbselect("select prefix from announcements inner join validated_roas_verified_announcements as o on announcements.id = verified_announcement_id where route_validity > 0 and not exists ( select verified_announcement_id from validated_roas_verified_announcements where route_validity = 0 and verified_announcement_id = o.verified_announcement_id ) and family(prefix) = 4 group by prefix;"):
-    for r in dbselect("select prefix from payload_roas where family(prefix) = 4 and filtered = true group by prefix;"):
-        yield r
+# conflicts found by conflict seeker (RIPE validator result)
+#raw_rpki_select = "select prefix from announcements inner join validated_roas_verified_announcements as o on announcements.id = verified_announcement_id where route_validity > 0 and not exists ( select verified_announcement_id from validated_roas_verified_announcements where route_validity = 0 and verified_announcement_id = o.verified_announcement_id ) and family(prefix) = 4 group by prefix;"
+raw_rpki_select = "select prefix from payload_roas where family(prefix) = 4 and filtered = true group by prefix;"
+
+
+def get_fltr_raw_rpki(conn=None):
+    return dbexport.dbselect(raw_rpki_select, conn)
 
 
 def get_fltr_resolved_conflicts():
@@ -69,14 +93,20 @@ def main():
         -r | --rpki -- filters traffic dropped by "raw" RPKI
         -e | --resolved -- filters traffic dropped in Smart mode
         -o | --outfile <out file>
+        -c | --copy -- export by COPY ... TO STDOUT (with -r)
+        -d | --delta <state file> -- write only prefixes added (+) and withdrawn (-) since the export kept in <state file>
+                                     (for external consumers, nfsim reads the full list in <state file>)
 """ % sys.argv[0])
 
 
     outfn = None
     fltr = None
+    select = None
+    copy = False
+    statefn = None
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hsreo:", ["help", "saved", "rpki", "resolved", "outfile="])
+        opts, args = getopt.getopt(sys.argv[1:], "hsreo:cd:", ["help", "saved", "rpki", "resolved", "outfile=", "copy", "delta="])
     except getopt.GetoptError as err:
         print(str(err))
         usage()
@@ -91,20 +121,32 @@ def main():
         elif o in ("-r", "--rpki"):
             assert fltr == None, "multiple filtering options"
             fltr = get_fltr_raw_rpki()
+            select = raw_rpki_select
         elif o in ("-e", "--resolved"):
             assert fltr == None, "multiple filtering options"
             fltr = get_fltr_resolved_conflicts()
         elif o in ("-o", "--outfile"):
             outfn = a
+        elif o in ("-c", "--copy"):
+            copy = True
+        elif o in ("-d", "--delta"):
+            statefn = a
         else:
             assert False, "unhandled option"
 
     assert fltr, "missing filter option"
     assert outfn, "missing out file"
-
-    with open(outfn, "w") as outfh:
-        for fr in fltr:
-            outfh.write("%s\n"%fr)
+    assert select or not copy, "COPY export is supported only with -r"
+    assert not (copy and statefn), "COPY export can not make delta"
+
+    if copy:
+        dbexport.copy_prefixes(select, outfn)
+    elif statefn:
+        (added, withdrawn) = write_delta(fltr, statefn, outfn)
+        dbg("written %d added and %d withdrawn prefixes to %s" % (added, withdrawn, outfn))
+    else:
+        count = dbexport.write_prefixes(fltr, outfn)
+        dbg("written %d prefixes to %s" % (count, outfn))
 
 
 if __name__ == '__main__':
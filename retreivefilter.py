@@ -3,13 +3,7 @@
 # SmartValidator - simulator component
 # by Tomas Hlavacek (tmshlvck@gmail.com)
 
-import password
-
 debug=0
-db_host=password.db_host
-db_name=password.db_name
-db_user=password.db_user
-db_passwd=password.db_passwd
 
 import sys
 import os
@@ -17,40 +11,27 @@ import datetime
 import tempfile
 import subprocess
 import getopt
-import psycopg2
 import csv
 
+import dbexport
+
 def dbg(text):
     if debug:
         print(text)
 
 
-def dbconn():
-    return 'host=%s dbname=%s user=%s password=%s' % (db_host, db_name, db_user, db_passwd)
-
-
-def dbselect(select):
-    conn = psycopg2.connect(dbconn())
-    cur = conn.cursor()
-    cur.execute(select)
-    for r in cur:
-        yield r
-
-    # conn.commit()
-    cur.close()
-    conn.close() 
-
-
 def get_fltr_saved_conflicts():
     # filtered / whitelisted from validated_roas (difference of our result from RIPE)
     # return list(dbselect("SELECT prefix FROM validated_roas WHERE filtered = 't';"))
     return debug_fltr
 
 
-def get_fltr_raw_rpki():
-    # conflicts found by conflict seeker (RIPE validator result)
-    for r in dbselect("select prefix from announcements inner join validated_roas_verified_announcements as o on announcements.id = verified_announcement_id where route_validity > 0 and not exists ( select verified_announcement_id from validated_roas_verified_announcements where route_validity = 0 and verified_announcement_id = o.verified_announcement_id ) and family(prefix) = 4 group by prefix;"):
-        yield r
+# conflicts found by conflict seeker (RIPE validator result)
+raw_rpki_select = "select prefix from announcements inner join validated_roas_verified_announcements as o on announcements.id = verified_announcement_id where route_validity > 0 and not exists ( select verified_announcement_id from validated_roas_verified_announcements where route_validity = 0 and verified_announcement_id = o.verified_announcement_id ) and family(prefix) = 4 group by prefix;"
+
+
+def get_fltr_raw_rpki(conn=None):
+    return dbexport.dbselect(raw_rpki_select, conn)
 
 
 def get_fltr_resolved_conflicts():
@@ -68,14 +49,17 @@ def main():
         -r | --rpki -- filters traffic dropped by "raw" RPKI
         -e | --resolved -- filters traffic dropped in Smart mode
         -o | --outfile <out file>
+        -c | --copy -- export by COPY ... TO STDOUT (with -r)
 """ % sys.argv[0])
 
 
     outfn = None
     fltr = None
+    select = None
+    copy = False
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hsreo:", ["help", "saved", "rpki", "resolved", "outfile="])
+        opts, args = getopt.getopt(sys.argv[1:], "hsreo:c", ["help", "saved", "rpki", "resolved", "outfile=", "copy"])
     except getopt.GetoptError as err:
         print(str(err))
         usage()
@@ -90,20 +74,26 @@ def main():
         elif o in ("-r", "--rpki"):
             assert fltr == None, "multiple filtering options"
             fltr = get_fltr_raw_rpki()
+            select = raw_rpki_select
         elif o in ("-e", "--resolved"):
             assert fltr == None, "multiple filtering options"
             fltr = get_fltr_resolved_conflicts()
         elif o in ("-o", "--outfile"):
             outfn = a
+        elif o in ("-c", "--copy"):
+            copy = True
         else:
             assert False, "unhandled option"
 
     assert fltr, "missing filter option"
     assert outfn, "missing out file"
+    assert select or not copy, "COPY export is supported only with -r"
 
-    with open(outfn, "w") as outfh:
-        for fr in fltr:
-            outfh.write("%s\n"%fr)
+    if copy:
+        dbexport.copy_prefixes(select, outfn)
+    else:
+        count = dbexport.write_prefixes(fltr, outfn)
+        dbg("written %d prefixes to %s" % (count, outfn))
 
 
 if __name__ == '__main__':
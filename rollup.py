@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# SmartValidator - simulator component
+# by Tomas Hlavacek (tmshlvck@gmail.com)
+
+"""
+Hourly and daily rollups of the simulator report in SQLite. nfsim adds
+every processed file to the rollups per router and overall (router '*'),
+so a query reads a few rows instead of the whole report CSV:
+
+    rollup.py [-P hour|day] [-r <router>] [-f <filter>] [-s <start>] [-e <end>] <rollup.db>
+"""
+
+import sys
+import csv
+import json
+import getopt
+import sqlite3
+
+import topk
+import hll
+
+# period name -> format of the period start
+periods = (('hour', '%Y-%m-%d %H:00:00'), ('day', '%Y-%m-%d 00:00:00'))
+
+# router of the rows summing up all routers
+all_routers = '*'
+
+estimate_columns = ('drop_distinct_src', 'drop_distinct_dst', 'drop_distinct_prefixes')
+
+
+class RollupStore(object):
+    """ Rollup table with one row per period, period start, router and
+    filter. The rows carry the number of files, the summed counters, the
+    merged top-k and HyperLogLog sketches (JSON) and the distinct
+    estimates of the merged sketches. Files already added are recorded so
+    that a file repeated after a crash is not counted twice. """
+
+    def __init__(self, filename, columns):
+        """
+        :param str filename: SQLite database file
+        :param list columns: Counter column names (nfsim CounterTable.header)
+        """
+        self.conn = sqlite3.connect(filename)
+        self.columns = list(columns)
+        self._create()
+
+    def _create(self):
+        cols = ''.join('"%s" INTEGER NOT NULL DEFAULT 0, ' % c for c in self.columns)
+        ests = ''.join('"%s" INTEGER, ' % c for c in estimate_columns)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS rollup (period TEXT NOT NULL, start TEXT NOT NULL, router TEXT NOT NULL, filter TEXT NOT NULL, files INTEGER NOT NULL, %s%stopk TEXT, hll TEXT, PRIMARY KEY (period, router, filter, start))' % (cols, ests))
+            self.conn.execute('CREATE INDEX IF NOT EXISTS rollup_start ON rollup (period, start)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS rollup_files (router TEXT NOT NULL, file TEXT NOT NULL, filter TEXT NOT NULL, PRIMARY KEY (router, file, filter))')
+        existing = [r[1] for r in self.conn.execute('PRAGMA table_info(rollup)')][5:5 + len(self.columns)]
+        if existing != self.columns:
+            raise ValueError("Rollup store has different counter columns, use another file")
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, router, filename, reports):
+        """ Add reports of one file to the rollups in one transaction.
+
+        :param str router: Router name
+        :param str filename: nfcapd file name
+        :param reports: List of (filter name or None, time, counters, sketches)
+        """
+        with self.conn:
+            for (name, time, counters, sketches) in reports:
+                fltr = name or ''
+                if self.conn.execute('SELECT 1 FROM rollup_files WHERE router = ? AND file = ? AND filter = ?', (router, filename, fltr)).fetchone():
+                    continue
+                self.conn.execute('INSERT INTO rollup_files (router, file, filter) VALUES (?, ?, ?)', (router, filename, fltr))
+                for (period, fmt) in periods:
+                    for r in (router, all_routers):
+                        self._add_row((period, time.strftime(fmt), r, fltr), counters, sketches)
+
+    def _add_row(self, key, counters, sketches):
+        row = self.conn.execute('SELECT topk, hll FROM rollup WHERE period = ? AND start = ? AND router = ? AND filter = ?', key).fetchone()
+        (summary, distinct) = (sketches.get('topk'), dict((k, sketches[k]) for k in hll.sidecar_keys if k in sketches))
+        if row and row[0] and summary:
+            summary = topk.SpaceSaving.from_dict(json.loads(row[0])).merge(summary)
+        if row and row[1] and distinct:
+            old = json.loads(row[1])
+            distinct = dict((k, hll.HyperLogLog.from_dict(old[k]).merge(h)) for (k, h) in distinct.items())
+
+        estimates = [distinct[k].estimate() for k in hll.sidecar_keys] if distinct else [None] * len(estimate_columns)
+        topk_json = json.dumps(summary.to_dict()) if summary else None
+        hll_json = json.dumps(dict((k, h.to_dict()) for (k, h) in distinct.items())) if distinct else None
+
+        names = ['period', 'start', 'router', 'filter', 'files'] + self.columns + list(estimate_columns) + ['topk', 'hll']
+        values = list(key) + [1] + list(counters) + estimates + [topk_json, hll_json]
+        update = ['files = files + 1'] + ['"%s" = "%s" + excluded."%s"' % (c, c, c) for c in self.columns]
+        update += ['"%s" = coalesce(excluded."%s", "%s")' % (c, c, c) for c in estimate_columns + ('topk', 'hll')]
+        self.conn.execute('INSERT INTO rollup (%s) VALUES (%s) ON CONFLICT (period, router, filter, start) DO UPDATE SET %s' % (
+            ', '.join('"%s"' % c for c in names), ', '.join('?' * len(names)), ', '.join(update)), values)
+
+    def query(self, period='hour', router=all_routers, fltr=None, start=None, end=None):
+        """ Rollup rows of router (all routers by default) and filter.
+
+        :param str period: 'hour' or 'day'
+        :param str router: Router name
+        :param str fltr: Filter name, None for the unnamed filter
+        :param str start: First period start ('YYYY-MM-DD HH:MM:SS' or its prefix)
+        :param str end: Period starts before end
+        :returns: (column names, list of rows) in time order, without the sketches
+        """
+        where = ['period = ?', 'router = ?', 'filter = ?']
+        args = [period, router, fltr or '']
+        if start:
+            where.append('start >= ?')
+            args.append(start)
+        if end:
+            where.append('start < ?')
+            args.append(end)
+        names = ['start', 'router', 'filter', 'files'] + self.columns + list(estimate_columns)
+        cur = self.conn.execute('SELECT %s FROM rollup WHERE %s ORDER BY start' % (', '.join('"%s"' % c for c in names), ' AND '.join(where)), args)
+        return (names, cur.fetchall())
+
+
+def open_store(filename):
+    """ Open existing rollup store with the counter columns it was created with.
+
+    :param str filename: SQLite database file
+    :returns: RollupStore
+    """
+    conn = sqlite3.connect('file:%s?mode=ro' % filename, uri=True)
+    try:
+        names = [r[1] for r in conn.execute('PRAGMA table_info(rollup)')]
+    finally:
+        conn.close()
+    if not names:
+        raise ValueError("No rollups in %s" % filename)
+    return RollupStore(filename, names[5:names.index(estimate_columns[0])])
+
+
+def main():
+    def usage():
+        print("""Query the report rollups
+    %s [-P hour|day] [-r <router>] [-f <filter>] [-s <start>] [-e <end>] <rollup.db>
+        -h | --help
+        -P | --period <hour|day> (default: hour)
+        -r | --router <router> (default: all routers)
+        -f | --filter <filter name> (default: the unnamed filter)
+        -s | --start <YYYY-MM-DD[ HH:MM:SS]> -- first period
+        -e | --end <YYYY-MM-DD[ HH:MM:SS]> -- periods before end
+""" % sys.argv[0])
+
+    period = 'hour'
+    router = all_routers
+    fltr = None
+    start = None
+    end = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hP:r:f:s:e:", ["help", "period=", "router=", "filter=", "start=", "end="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-P", "--period"):
+            period = a
+        elif o in ("-r", "--router"):
+            router = a
+        elif o in ("-f", "--filter"):
+            fltr = a
+        elif o in ("-s", "--start"):
+            start = a
+        elif o in ("-e", "--end"):
+            end = a
+        else:
+            assert False, "unhandled option"
+
+    assert period in [p for (p, fmt) in periods], "unknown period %s" % period
+    assert len(args) == 1, "missing rollup file"
+
+    store = open_store(args[0])
+    (names, rows) = store.query(period, router, fltr, start, end)
+    store.close()
+    out = csv.writer(sys.stdout, quoting=csv.QUOTE_MINIMAL)
+    out.writerow(names)
+    out.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# SmartValidator - simulator component
+# by Tomas Hlavacek (tmshlvck@gmail.com)
+
+"""
+End-to-end self-check of nfsim on generated nfcapd files of two routers
+with the same file names. Large files split to parts (--split-size) have
+to give the same report and dropped flows as whole files and no part
+files may be left. The checks of iptree, of the filter compaction and
+of the flow sampling (with and without numpy) are run first:
+
+    simcheck.py [-r <records per file>]
+"""
+
+import sys
+import os
+import csv
+import shutil
+import getopt
+import tempfile
+import gzip
+import random
+import ipaddress
+
+import nfcapd
+import nfsim
+import iptree
+
+routers = ('r1', 'r2')
+times = ('201712160900', '201712160905', '201712160910')
+
+
+def make_tree(rootdir, records):
+    """ Write NFSen tree <rootdir>/<router>/2017/12/16/nfcapd.<time> of
+    generated files.
+
+    :param str rootdir: Root directory
+    :param int records: Records per file
+    :returns: Maximum file size
+    """
+    size = 0
+    for (i, router) in enumerate(routers):
+        d = os.path.join(rootdir, router, '2017', '12', '16')
+        os.makedirs(d)
+        for (j, t) in enumerate(times):
+            fn = os.path.join(d, 'nfcapd.%s' % t)
+            nfcapd.write_nfcapd(fn, nfcapd.random_records(records, seed=i * len(times) + j), block_records=100)
+            size = max(size, os.path.getsize(fn))
+    return size
+
+
+def run(workdir, rootdir, fltrfn, name, split_size, fmt='csv', compress=None):
+    """ Process rootdir with the native reader, returns (sorted report rows,
+    output directory).
+    """
+    outdir = os.path.join(workdir, name)
+    os.makedirs(outdir)
+    reportfn = os.path.join(workdir, '%s.csv' % name)
+    journal = nfsim.Journal(os.path.join(workdir, '%s.journal' % name), os.path.join(workdir, '%s.status' % name))
+    nfsim.flow_output = nfsim.FlowOutput(fmt, compress)
+    (p, nfdump_filters) = nfsim.start_pool([(None, fltrfn)], outdir, native=True)
+    try:
+        nfsim.write_report(p, list(nfsim.find_files(rootdir)), reportfn, [None], journal, split_size, outdir)
+    finally:
+        nfsim.stop_pool(p, nfdump_filters)
+    with open(reportfn, 'r') as fh:
+        return (sorted(list(csv.reader(fh))[1:]), outdir)
+
+
+def read_output(outdir):
+    """ Contents of the dropped-flow files under outdir by path (decompressed,
+    gzip streams of joined parts differ in bytes).
+    """
+    out = {}
+    for (d, dirs, fns) in os.walk(outdir):
+        for fn in fns:
+            path = os.path.join(d, fn)
+            with (gzip.open(path, 'rb') if fn.endswith('.gz') else open(path, 'rb')) as fh:
+                out[os.path.relpath(path, outdir)] = fh.read()
+    return out
+
+
+def check_compaction(n=1000, seed=1):
+    """ Compare nfsim.compact_prefixes and nfsim.range_prefixes with
+    ipaddress.collapse_addresses and summarize_address_range.
+
+    :param int n: Number of random prefix lists and ranges
+    :param int seed: Random seed
+    :raises AssertionError: When the prefixes differ
+    """
+    def networks(prefixes):
+        return sorted(ipaddress.IPv4Network(p) for p in prefixes)
+
+    rnd = random.Random(seed)
+    for i in range(n):
+        # prefixes in a small block, so that they nest, touch and overlap
+        base = rnd.getrandbits(32) & ~0xffff if i % 10 else 0
+        prefixes = []
+        for j in range(rnd.randint(0, 20)):
+            length = rnd.choice((0, 1, 8, 16)) if j == 0 and i % 50 == 0 else rnd.randint(16, 32)
+            prefixes.append(((base | rnd.getrandbits(16)) & ~((1 << (32 - length)) - 1), length))
+        got = nfsim.compact_prefixes(prefixes)
+        assert networks(got) == sorted(ipaddress.collapse_addresses(networks(prefixes))), "compact_prefixes %s" % prefixes
+
+        start = rnd.choice((0, base, base | rnd.getrandbits(16)))
+        end = rnd.choice((start + 1, (start | 0xffff) + 1, start + 1 + rnd.getrandbits(rnd.randint(1, 24)), 1 << 32))
+        end = min(end, 1 << 32)
+        exp = list(ipaddress.summarize_address_range(ipaddress.IPv4Address(start), ipaddress.IPv4Address(end - 1)))
+        assert networks(nfsim.range_prefixes(start, end)) == exp, "range_prefixes %d %d" % (start, end)
+
+
+def check_sampling(records=5000):
+    """ Compare nfsim.sample_chunks with and without numpy against sampling
+    the records one by one by nfsim.sample_hash. Includes chunks of which
+    no flow is sampled.
+
+    :param int records: Number of generated records
+    :raises AssertionError: When the samples differ
+    """
+    recs = nfcapd.random_records(records)
+    numpy = nfsim.numpy
+    try:
+        for (rate, size) in ((10, 1000), (1000, 5)):
+            chunks = list(nfsim.chunk_records(recs, size))
+            exp = [[r for r in nfsim.chunk_rows(c) if nfsim.sample_hash(r) % rate == 0] for c in chunks]
+            assert rate < 1000 or [] in exp, "no empty sample of rate %d" % rate
+            for mode in ((numpy, None) if numpy else (None,)):
+                nfsim.numpy = mode
+                got = [list(nfsim.chunk_rows(c)) for c in nfsim.sample_chunks(chunks, rate)]
+                assert got == exp, "sample of rate %d %s numpy differs" % (rate, 'with' if mode else 'without')
+    finally:
+        nfsim.numpy = numpy
+
+
+def check(records=5000):
+    """ Compare whole and split processing of two routers.
+
+    :param int records: Records per generated file
+    :raises AssertionError: When the results differ
+    """
+    nfsim.debug = 0
+    workdir = tempfile.mkdtemp(prefix='simcheck_')
+    try:
+        fltrfn = os.path.join(workdir, 'filter.txt')
+        with open(fltrfn, 'w') as fh:
+            fh.write('0.0.0.0/2\n160.0.0.0/3\n')
+
+        rootdir = os.path.join(workdir, 'nfsen')
+        size = make_tree(rootdir, records)
+        for (fmt, compress) in (('csv', None), ('bin', 'gzip')):
+            (whole, wholedir) = run(workdir, rootdir, fltrfn, fmt + '-whole', 0, fmt, compress)
+            (split, splitdir) = run(workdir, rootdir, fltrfn, fmt + '-split', size // 5, fmt, compress)
+            assert len(whole) == len(routers) * len(times), "%s: %d report rows" % (fmt, len(whole))
+            assert whole == split, "%s: split report differs" % fmt
+            (wholeout, splitout) = (read_output(wholedir), read_output(splitdir))
+            left = [fn for fn in splitout if '.part' in fn]
+            assert not left, "%s: part files left %s" % (fmt, left)
+            assert len(wholeout) == len(routers) * len(times) * (1 if fmt == 'csv' else len(nfsim.record_columns)), "%s: %d output files" % (fmt, len(wholeout))
+            assert wholeout == splitout, "%s: split output differs" % fmt
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    def usage():
+        print("""nfsim self-check
+    %s [-r <records per file>]
+        -h | --help
+        -r | --records <n> -- records of each generated nfcapd file (default: 5000)
+""" % sys.argv[0])
+
+    records = 5000
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hr:", ["help", "records="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-r", "--records"):
+            records = int(a)
+        else:
+            assert False, "unhandled option"
+
+    iptree.check()
+    check_compaction()
+    check_sampling(records)
+    check(records)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# SmartValidator - simulator component
+# by Tomas Hlavacek (tmshlvck@gmail.com)
+
+"""
+Bounded-memory heavy hitters (Space-Saving, Metwally et al.) used to
+attribute dropped traffic to filter prefixes. Summaries are kept per file
+and filter in JSON sidecars, they can be merged across routers and hours:
+
+    topk.py [-k <k>] -o <out.json> <sidecar.json> ...
+"""
+
+import sys
+import json
+import heapq
+import getopt
+
+
+class SpaceSaving(object):
+    """ Top-k keys by bytes with packets and flows carried along.
+
+    Every tracked key has [bytes, packets, flows, error]. A new key that
+    does not fit replaces the key with the least bytes and inherits its
+    bytes as error, so bytes are overestimated by at most error, packets
+    and flows count only since the key has been tracked.
+    """
+
+    def __init__(self, k):
+        """
+        :param int k: Number of tracked keys
+        """
+        self.k = k
+        self.items = {}
+        # (bytes, key), one entry per key, updated lazily when popped
+        self.heap = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def _pop_min(self):
+        while True:
+            (count, key) = heapq.heappop(self.heap)
+            if self.items[key][0] == count:
+                return (count, key)
+            heapq.heappush(self.heap, (self.items[key][0], key))
+
+    def add(self, key, nbytes, packets=0, flows=1):
+        """ Count traffic of key.
+
+        :param str key: Key (prefix)
+        :param int nbytes: Bytes
+        :param int packets: Packets
+        :param int flows: Flows
+        """
+        item = self.items.get(key)
+        if item:
+            item[0] += nbytes
+            item[1] += packets
+            item[2] += flows
+        elif len(self.items) < self.k:
+            self.items[key] = [nbytes, packets, flows, 0]
+            heapq.heappush(self.heap, (nbytes, key))
+        else:
+            (count, old) = self._pop_min()
+            del self.items[old]
+            self.items[key] = [count + nbytes, packets, flows, count]
+            heapq.heappush(self.heap, (count + nbytes, key))
+
+    def scale(self, factor):
+        """ Multiply all counts by factor (e.g. to scale up a sample).
+
+        :param int factor: Factor
+        """
+        for item in self.items.values():
+            for i in range(4):
+                item[i] *= factor
+        self.heap = [(item[0], key) for (key, item) in self.items.items()]
+        heapq.heapify(self.heap)
+
+    def min_count(self):
+        """ Bytes any key that is not tracked can have at most.
+
+        :returns: int
+        """
+        if len(self.items) < self.k:
+            return 0
+        return min(item[0] for item in self.items.values())
+
+    def merge(self, other):
+        """ Add other summary to this one (the result keeps self.k keys).
+
+        :param SpaceSaving other: Summary to add
+        :returns: self
+        """
+        (ma, mb) = (self.min_count(), other.min_count())
+        items = {}
+        for key in set(self.items) | set(other.items):
+            a = self.items.get(key, [ma, 0, 0, ma])
+            b = other.items.get(key, [mb, 0, 0, mb])
+            items[key] = [x + y for (x, y) in zip(a, b)]
+        top = heapq.nlargest(self.k, items.items(), key=lambda kv: kv[1][0])
+        self.items = dict(top)
+        self.heap = [(item[0], key) for (key, item) in top]
+        heapq.heapify(self.heap)
+        return self
+
+    def top(self, n=None):
+        """ Tracked keys, the biggest first.
+
+        :param int n: Number of keys, all when None
+        :returns: List of (key, bytes, packets, flows, error)
+        """
+        items = sorted(self.items.items(), key=lambda kv: (-kv[1][0], kv[0]))
+        return [(key,) + tuple(item) for (key, item) in items[:n]]
+
+    def to_dict(self):
+        return {'k': self.k, 'items': [list(t) for t in self.top()]}
+
+    @staticmethod
+    def from_dict(d):
+        s = SpaceSaving(d['k'])
+        for (key, nbytes, packets, flows, error) in d['items']:
+            s.items[key] = [nbytes, packets, flows, error]
+        s.heap = [(item[0], key) for (key, item) in s.items.items()]
+        heapq.heapify(s.heap)
+        return s
+
+
+def write_sidecar(filename, summary, meta=None):
+    """ Write summary to JSON sidecar file.
+
+    :param str filename: Output file name
+    :param SpaceSaving summary: Summary to write
+    :param dict meta: Optional description (file, router, time, filter)
+    """
+    d = dict(meta or {})
+    d.update(summary.to_dict())
+    with open(filename, 'w') as fh:
+        json.dump(d, fh)
+
+
+def read_sidecar(filename):
+    """ Read summary from JSON sidecar file.
+
+    :param str filename: Sidecar file name
+    :returns: SpaceSaving
+    """
+    with open(filename, 'r') as fh:
+        return SpaceSaving.from_dict(json.load(fh))
+
+
+def main():
+    def usage():
+        print("""Merge top-k drop attribution sidecars
+    %s [-k <k>] -o <out.json> <sidecar.json> ...
+        -h | --help
+        -k | --keys <k> -- keys in the merged summary (default: k of the first sidecar)
+        -o | --outfile <merged sidecar>
+""" % sys.argv[0])
+
+    k = None
+    outfn = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hk:o:", ["help", "keys=", "outfile="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-k", "--keys"):
+            k = int(a)
+        elif o in ("-o", "--outfile"):
+            outfn = a
+        else:
+            assert False, "unhandled option"
+
+    assert args, "missing sidecar files"
+    assert outfn, "missing out file"
+
+    merged = None
+    for fn in args:
+        s = read_sidecar(fn)
+        if merged is None:
+            merged = SpaceSaving(k or s.k)
+        merged.merge(s)
+    write_sidecar(outfn, merged, {'files': len(args)})
+
+
+if __name__ == '__main__':
+    main()